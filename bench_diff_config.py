@@ -0,0 +1,526 @@
+#!/usr/bin/python2.7
+#
+# October 2026
+
+"""Benchmark the moving parts of diff_config.
+
+Each benchmark generates its own synthetic input so runs are repeatable and
+prints a table of the results, or JSON with --json so that results can be
+compared between revisions.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import resource
+import argparse
+import multiprocessing
+
+import diff_config
+
+SERVICE_NAMES = ('ssh', 'smtp', 'domain', 'http', 'kerberos', 'pop3', 'ntp',
+                 'imap', 'snmp', 'ldap', 'https', 'syslog', 'ipp', 'rsync')
+SSHD_DIRECTIVES = ('PermitRootLogin', 'PasswordAuthentication', 'AllowUsers',
+                   'X11Forwarding', 'MaxSessions', 'ClientAliveInterval',
+                   'AcceptEnv', 'Banner', 'ForceCommand',
+                   'PubkeyAuthentication')
+INDEX_LAYOUTS = ('index', 'lists')
+
+
+def GenerateConfig(conf_format, target_bytes, seed=0):
+  """Build a synthetic config file of roughly the requested size.
+
+  Args:
+    conf_format: A string of diff_config.FORMAT_KV, FORMAT_INI or FORMAT_SSHD.
+    target_bytes: An int of the size to grow the file to.
+    seed: An int seeding the random values.
+
+  Returns:
+    A string of the config file content.
+  """
+  rand = random.Random(seed)
+  lines = []
+  size = 0
+  count = 0
+  while size < target_bytes:
+    if conf_format == diff_config.FORMAT_INI:
+      if count % 50 == 0:
+        line = '[section%d]' % (count // 50)
+      elif count % 7 == 0:
+        line = '; a comment about option%d' % count
+      else:
+        line = 'option%d = %d ; default %d' % (count, rand.randint(0, 9999),
+                                               rand.randint(0, 9))
+    elif conf_format == diff_config.FORMAT_SSHD:
+      if count % 40 == 0:
+        line = 'Match User user%d' % (count // 40)
+      elif count % 9 == 0:
+        line = '# %s is documented in sshd_config(5)' % rand.choice(
+            SSHD_DIRECTIVES)
+      else:
+        line = '\t%s %s' % (rand.choice(SSHD_DIRECTIVES),
+                            rand.choice(('yes', 'no', '30', 'LANG LC_*')))
+    else:
+      # modelled on /etc/services
+      if count % 11 == 0:
+        line = '# Updated from the registry'
+      else:
+        name = '%s%d' % (rand.choice(SERVICE_NAMES), count)
+        line = '%s\t\t%d/%s\t\t# %s service' % (
+            name, count % 65536, rand.choice(('tcp', 'udp')), name)
+    lines.append(line)
+    size += len(line) + 1
+    count += 1
+  return '\n'.join(lines) + '\n'
+
+
+def TimeParse(content, conf_format, repeat):
+  """Time ParseConfigFile over a buffer, keeping the best run.
+
+  Args:
+    content: A string of the config file content.
+    conf_format: A string of the config file syntax.
+    repeat: An int of the runs to make.
+
+  Returns:
+    best: A float of the fastest run in seconds.
+    tokens: An int of the (section, directive, value) tuples emitted.
+  """
+  best = None
+  tokens = 0
+  for run in range(repeat):
+    start = time.time()
+    parser = diff_config.ParseConfigFile(None, 'bench', content,
+                                         conf_format).Parse()
+    elapsed = time.time() - start
+    tokens = len(parser.effective_config)
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, tokens
+
+
+def BenchParse(args):
+  """Measure the tokenizer throughput on multi-megabyte config files.
+
+  Args:
+    args: An argparse.Namespace of the command line.
+
+  Returns:
+    results: A list of dicts, one per input.
+  """
+  inputs = []
+  for path in args.file:
+    with open(path, 'rb') as file_obj:
+      content = file_obj.read()
+    inputs.append((path, diff_config.DetectFormat(path, content), content))
+  if not args.file:
+    for conf_format in (diff_config.FORMAT_KV, diff_config.FORMAT_INI,
+                        diff_config.FORMAT_SSHD):
+      content = GenerateConfig(conf_format, args.size * 1024 * 1024)
+      inputs.append(('synthetic-%s' % conf_format, conf_format, content))
+
+  results = []
+  for name, conf_format, content in inputs:
+    seconds, tokens = TimeParse(content, conf_format, args.repeat)
+    lines = content.count('\n')
+    results.append({'benchmark': 'parse', 'input': name,
+                    'format': conf_format, 'bytes': len(content),
+                    'lines': lines, 'tokens': tokens, 'seconds': seconds,
+                    'lines_per_sec': lines / seconds,
+                    'mb_per_sec': len(content) / seconds / 1024 / 1024})
+  return results
+
+
+def GenerateFleetConfigs(machines, directives, drift, divergent=1.0, seed=0):
+  """Build the parsed configs of a synthetic fleet one host at a time.
+
+  Every host starts from the same config. A divergent fraction of them
+  rewrite a drift fraction of their directives with values from a small
+  shared vocabulary and carry one line of their own, so each of those is a
+  variant of its own while the rest share the base variant.
+
+  Args:
+    machines: A list of the host names.
+    directives: An int of the directives per config.
+    drift: A float of the fraction of directives each divergent host
+      rewrites.
+    divergent: A float of the fraction of hosts that diverge.
+    seed: An int seeding the random values.
+
+  Yields:
+    (host name, list of (section, directive, value) tuples) tuples.
+  """
+  rand = random.Random(seed)
+  base = [rand.randint(0, 9) for number in range(directives)]
+  changed = max(1, int(directives * drift))
+  for mach_name in machines:
+    values = base[:]
+    diverges = rand.random() < divergent
+    if diverges:
+      for number in rand.sample(range(directives), changed):
+        values[number] = rand.randint(0, 99)
+    # fresh strings per host, as the parser would hand them over
+    config = [('', 'Directive%d' % number, 'value %d' % value)
+              for number, value in enumerate(values)]
+    if diverges:
+      config.append(('', 'HostName', mach_name))
+    yield mach_name, config
+
+
+def ResidentBytes():
+  """Measure the resident memory of the process.
+
+  Returns:
+    An int of bytes, the peak resident size where /proc is missing.
+  """
+  gc.collect()
+  try:
+    with open('/proc/self/statm') as statm:
+      return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except IOError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def MeasureIndex(layout, hosts, directives, drift):
+  """Build one fleet matrix and measure the memory it holds on to.
+
+  Meant to run in a fresh process so earlier runs do not skew the numbers.
+
+  Args:
+    layout: A string of 'index' for a ConfigDiffIndex or 'lists' for a list
+      of parsed configs per host.
+    hosts: An int of the hosts to generate.
+    directives: An int of the directives per config.
+    drift: A float of the fraction of directives each host rewrites.
+
+  Returns:
+    grown: An int of the bytes the resident size grew by.
+    seconds: A float of the time spent building.
+    variants: An int of the distinct configs held.
+  """
+  machines = ['host%05d.example.com' % host for host in range(hosts)]
+  before = ResidentBytes()
+  start = time.time()
+  if layout == 'index':
+    held = diff_config.ConfigDiffIndex('bench')
+    for mach_name, config in GenerateFleetConfigs(machines, directives, drift):
+      held.AddConfig(mach_name, config)
+    variants = len(held.digests)
+  else:
+    held = dict(GenerateFleetConfigs(machines, directives, drift))
+    variants = len(held)
+  seconds = time.time() - start
+  return ResidentBytes() - before, seconds, variants
+
+
+def BenchMemory(args):
+  """Compare the memory of the fleet matrix layouts as the fleet grows.
+
+  Args:
+    args: An argparse.Namespace of the command line.
+
+  Returns:
+    results: A list of dicts, one per layout and fleet size.
+  """
+  results = []
+  for hosts in args.hosts:
+    for layout in INDEX_LAYOUTS:
+      pool = multiprocessing.Pool(1)
+      grown, seconds, variants = pool.apply(
+          MeasureIndex, (layout, hosts, args.directives, args.drift))
+      pool.close()
+      pool.join()
+      results.append({'benchmark': 'memory', 'layout': layout,
+                      'hosts': hosts, 'directives': args.directives,
+                      'variants': variants, 'bytes': grown,
+                      'bytes_per_host': grown / hosts, 'seconds': seconds})
+  return results
+
+
+def ServeBanner(banner):
+  """Answer every TCP connection on a local port with a banner.
+
+  Args:
+    banner: A string sent to each client before hanging up.
+
+  Returns:
+    An int of the port listened on, on every local address.
+  """
+  listener = socket.socket()
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind(('0.0.0.0', 0))
+  listener.listen(4096)
+
+  def Serve():
+    while True:
+      conn = listener.accept()[0]
+      try:
+        conn.sendall(banner)
+      except socket.error:
+        pass
+      conn.close()
+
+  serve_thread = threading.Thread(target=Serve)
+  serve_thread.setDaemon(True)
+  serve_thread.start()
+  return listener.getsockname()[1]
+
+
+def WriteFleet(root, machines, configfile, directives, drift, divergent):
+  """Write a synthetic fleet out as one directory per host.
+
+  Args:
+    root: A string of the directory LocalDirTransport reads from.
+    machines: A list of the host names.
+    configfile: A string of the absolute config file path.
+    directives: An int of the directives per config.
+    drift: A float of the fraction of directives each divergent host
+      rewrites.
+    divergent: A float of the fraction of hosts that diverge.
+
+  Returns:
+    An int of the bytes written.
+  """
+  written = 0
+  for mach_name, config in GenerateFleetConfigs(machines, directives, drift,
+                                                divergent):
+    path = os.path.join(root, mach_name, configfile.lstrip('/'))
+    os.makedirs(os.path.dirname(path))
+    content = ''.join('%s %s\n' % (name, value)
+                      for _, name, value in config)
+    with open(path, 'w') as conf:
+      conf.write(content)
+    written += len(content)
+  return written
+
+
+def TimeFleet(root, machines, configfile, port, jobs):
+  """Time each stage of a diff_config run over a synthetic fleet.
+
+  The stages run one after the other so each gets its own number, followed
+  by the regular overlapped fetch and index for the end to end figure.
+
+  Args:
+    root: A string of the directory holding one sub directory per host.
+    machines: A list of the host names, local addresses answering on port.
+    configfile: A string of the absolute config file path.
+    port: An int of the port the banner server listens on.
+    jobs: An int of the hosts fetched from at once.
+
+  Returns:
+    A dict of stage -> seconds, along with the variants found.
+  """
+  stages = {}
+  start = time.time()
+  available = diff_config.HostProber(port=port, timeout=5.0).Probe(
+      machines)[0]
+  stages['probe'] = time.time() - start
+  if len(available) != len(machines):
+    raise RuntimeError('only %d of %d hosts answered the probe' % (
+        len(available), len(machines)))
+
+  transport = diff_config.LocalDirTransport(root)
+  scheduler = diff_config.HostScheduler(jobs, jobs, min_limit=jobs,
+                                        retries=0)
+  start = time.time()
+  parse_queue = diff_config.StartFetchers(transport, machines, [configfile],
+                                          scheduler)
+  fetched = []
+  machs_left = len(machines)
+  while machs_left:
+    path, mach, content = parse_queue.get()
+    if path is None:
+      machs_left -= 1
+    else:
+      fetched.append((mach, content))
+  stages['fetch'] = time.time() - start
+
+  start = time.time()
+  parsed = []
+  parsers = {}
+  for mach, content in fetched:
+    digest = hashlib.sha256(content).hexdigest()
+    if digest not in parsers:
+      parsers[digest] = diff_config.ParseContent(
+          configfile, mach, content, None, diff_config.FORMAT_KV)
+    parsed.append((mach, digest))
+  stages['parse'] = time.time() - start
+
+  start = time.time()
+  diff_index = diff_config.ConfigDiffIndex(configfile, machines)
+  for mach, digest in parsed:
+    if not diff_index.AddMachine(mach, digest):
+      diff_index.AddConfig(mach, parsers[digest].effective_config,
+                           digest=digest)
+  for directive in diff_index.visible_directives:
+    diff_config.FindOutliers(diff_index.Histogram(directive))
+  stages['diff'] = time.time() - start
+
+  start = time.time()
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    diff_config.PrintPretty(diff_index, True, machines)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  stages['render'] = time.time() - start
+
+  start = time.time()
+  diff_config.FetchAndIndex(transport, machines, [configfile], None,
+                            scheduler=scheduler,
+                            conf_format=diff_config.FORMAT_KV)
+  stages['end_to_end'] = time.time() - start
+  stages['variants'] = len(diff_index.digests)
+  return stages
+
+
+def BenchFleet(args):
+  """Time every stage against synthetic fleets of growing size.
+
+  Hosts are named after loopback addresses so the probe reaches a local
+  banner server, and their config files are read from a temporary
+  directory through LocalDirTransport.
+
+  Args:
+    args: An argparse.Namespace of the command line.
+
+  Returns:
+    results: A list of dicts, one per fleet size.
+  """
+  configfile = '/etc/bench.conf'
+  port = ServeBanner(diff_config.SSH_BANNER + 'bench\r\n')
+  results = []
+  for hosts in args.hosts:
+    machines = ['127.%d.%d.%d' % (host // 62500, host // 250 % 250,
+                                  host % 250 + 1) for host in range(hosts)]
+    root = tempfile.mkdtemp()
+    try:
+      written = WriteFleet(root, machines, configfile, args.directives,
+                           args.drift, args.divergent)
+      result = TimeFleet(root, machines, configfile, port, args.jobs)
+    finally:
+      shutil.rmtree(root, ignore_errors=True)
+    result.update({'benchmark': 'fleet', 'hosts': hosts,
+                   'directives': args.directives, 'bytes': written})
+    results.append(result)
+  return results
+
+
+def PrintResults(results, columns):
+  """Print benchmark results as a table.
+
+  Args:
+    results: A list of result dicts.
+    columns: A list of the keys to print.
+  """
+  rows = [columns]
+  for result in results:
+    row = []
+    for column in columns:
+      value = result[column]
+      if isinstance(value, float):
+        value = '%.3f' % value
+      row.append(str(value))
+    rows.append(row)
+  widths = [max(len(row[index]) for row in rows)
+            for index in range(len(columns))]
+  spacer = '  '.join('%' + str(width) + 's' for width in widths)
+  for row in rows:
+    print spacer % tuple(row)
+
+
+def CommaSeparateInts(value):
+  """Turn a comma separated argument into ints.
+
+  Args:
+    value: A string of comma separated integers.
+
+  Returns:
+    A list of ints.
+  """
+  return [int(number) for number in value.split(',')]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark diff_config.')
+  parser.add_argument('--json', action='store_true',
+                      help='Print the results as JSON')
+  subparsers = parser.add_subparsers(dest='benchmark')
+
+  parse_parser = subparsers.add_parser('parse', help='Tokenizer throughput')
+  parse_parser.add_argument('file', nargs='*',
+                            help='Config files to parse instead of the '
+                            'synthetic ones')
+  parse_parser.add_argument('-s', '--size', type=int, default=8,
+                            help='Megabytes per synthetic file. Defaults to '
+                            '%(default)s.')
+  parse_parser.add_argument('-r', '--repeat', type=int, default=3,
+                            help='Runs per input, the best is kept. Defaults '
+                            'to %(default)s.')
+
+  memory_parser = subparsers.add_parser('memory',
+                                        help='Fleet matrix memory use')
+  memory_parser.add_argument('-H', '--hosts', type=CommaSeparateInts,
+                             default=[1000, 10000],
+                             help='Comma separated fleet sizes. Defaults to '
+                             '1000,10000.')
+  memory_parser.add_argument('-D', '--directives', type=int, default=200,
+                             help='Directives per config. Defaults to '
+                             '%(default)s.')
+  memory_parser.add_argument('--drift', type=float, default=0.05,
+                             help='Fraction of directives each host rewrites. '
+                             'Defaults to %(default)s.')
+
+  fleet_parser = subparsers.add_parser('fleet',
+                                       help='End to end stage timings')
+  fleet_parser.add_argument('-H', '--hosts', type=CommaSeparateInts,
+                            default=[10, 100, 1000, 10000],
+                            help='Comma separated fleet sizes. Defaults to '
+                            '10,100,1000,10000.')
+  fleet_parser.add_argument('-D', '--directives', type=int, default=200,
+                            help='Directives per config. Defaults to '
+                            '%(default)s.')
+  fleet_parser.add_argument('--drift', type=float, default=0.05,
+                            help='Fraction of directives each divergent host '
+                            'rewrites. Defaults to %(default)s.')
+  fleet_parser.add_argument('--divergent', type=float, default=0.1,
+                            help='Fraction of hosts that diverge from the '
+                            'base config. Defaults to %(default)s.')
+  fleet_parser.add_argument('-j', '--jobs', type=int, default=32,
+                            help='Hosts fetched from at once. Defaults to '
+                            '%(default)s.')
+  args = parser.parse_args()
+
+  if args.benchmark == 'parse':
+    results = BenchParse(args)
+    columns = ['input', 'format', 'bytes', 'lines', 'tokens', 'seconds',
+               'lines_per_sec', 'mb_per_sec']
+  elif args.benchmark == 'memory':
+    results = BenchMemory(args)
+    columns = ['layout', 'hosts', 'directives', 'variants', 'bytes',
+               'bytes_per_host', 'seconds']
+  elif args.benchmark == 'fleet':
+    results = BenchFleet(args)
+    columns = ['hosts', 'variants', 'bytes', 'probe', 'fetch', 'parse',
+               'diff', 'render', 'end_to_end']
+
+  if args.json:
+    print json.dumps(results, indent=2, sort_keys=True)
+  else:
+    PrintResults(results, columns)
+
+
+if __name__ == '__main__':
+  try:
+    main()
+  except KeyboardInterrupt:
+    sys.exit('\nHalting')
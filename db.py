@@ -12,55 +12,493 @@ width permitting) to the screen.
 
 import os
 import re
-import subprocess
+import cmd
+import csv
+import sys
+import gzip
+import json
+import base64
+import collections
+import time
+import struct
+import errno
+import urllib
+import cPickle
+import tempfile
+import itertools
+import shutil
+import multiprocessing
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 import sqlite3
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 DATABASE_SUFFIX = '.db'
 #DATABASE_SUFFIX = 'Login Data'
+# the first 16 bytes of every SQLite 3 database
+SQLITE_MAGIC = 'SQLite format 3\000'
+SNIFF_WORKERS = 8
+QUERY_WORKERS = 4
+FETCH_ROWS = 1000
+SAMPLE_ROWS = 1000
+# prepared statements kept per connection by the interactive shell
+STATEMENT_CACHE = 256
+# how databases are opened for queries
+OPEN_READ_WRITE = 'rw'
+OPEN_READ_ONLY = 'ro'
+OPEN_IMMUTABLE = 'immutable'
+# the query phases timed by --profile
+PROFILE_PHASES = ('open', 'execute', 'fetch', 'format')
+# the slowest databases listed in the profile summary
+PROFILE_SLOWEST = 5
+# a query plan step reading a whole table, rather than through an index
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?([^ (]\S*)(?: AS \S+)?$')
+# a table named in a FROM or JOIN clause and the alias that follows it
+TABLE_ALIAS = re.compile(r'(?:\bFROM|\bJOIN|,)\s+([A-Za-z_][\w.]*|"[^"]+")\s+'
+                         r'(?:AS\s+)?([A-Za-z_]\w*|"[^"]+")', re.I)
+# words that may follow a table name where an alias would
+NOT_ALIASES = frozenset(['CROSS', 'EXCEPT', 'FULL', 'GROUP', 'HAVING',
+                         'INDEXED', 'INNER', 'INTERSECT', 'JOIN', 'LEFT',
+                         'LIMIT', 'NATURAL', 'NOT', 'ON', 'ORDER', 'OUTER',
+                         'RIGHT', 'UNION', 'USING', 'WHERE', 'WINDOW'])
+# page cache and memory map sizes of databases opened read only
+CACHE_KIB = 64 * 1024
+MMAP_BYTES = 256 * 1024 * 1024
+# results kept in memory before a parallel query spills them to disk
+SPILL_BYTES = 8 * 1024 * 1024
+# parallel queries run at most this many times the jobs ahead of the printer
+QUERY_LOOKAHEAD = 2
+# SQLite refuses more attached databases than this by default
+ATTACH_LIMIT = 10
+# the column naming the database each federated row came from
+SOURCE_COLUMN = 'source_db'
+EXPORT_CSV = 'csv'
+EXPORT_TSV = 'tsv'
+EXPORT_NDJSON = 'ndjson'
+EXPORT_FORMATS = (EXPORT_CSV, EXPORT_TSV, EXPORT_NDJSON)
+CATALOG_DB = os.path.expanduser('~/.db_schema_catalog.db')
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  mtime REAL NOT NULL,
+  size INTEGER NOT NULL,
+  schema_version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+  path TEXT NOT NULL,
+  type TEXT NOT NULL,
+  name TEXT NOT NULL,
+  tbl_name TEXT,
+  sql TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_path ON objects (path);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS columns (
+  path TEXT NOT NULL,
+  table_name TEXT NOT NULL,
+  cid INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  type TEXT,
+  not_null INTEGER,
+  pk INTEGER
+);
+CREATE INDEX IF NOT EXISTS columns_path ON columns (path);
+CREATE INDEX IF NOT EXISTS columns_name ON columns (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS sniffed (
+  path TEXT PRIMARY KEY,
+  inode INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  size INTEGER NOT NULL,
+  is_db INTEGER NOT NULL
+);
+"""
+
+# path -> ((inode, mtime, size), whether the file is an SQLite database)
+_SNIFFED = {}
+# whether SQLite reads file: URIs, set on first use
+_URI_FILENAMES = None
+
+
+def ListFiles(top, recursive=False):
+  """List the regular files in a directory.
+
+  Args:
+    top: A string of the directory to list.
+    recursive: A boolean to indicate if sub directories are listed too.
+
+  Returns:
+    files: A sorted list of file paths relative to top.
+  """
+  files = []
+  if scandir is None:
+    if recursive:
+      for dir_path, dir_names, file_names in os.walk(top):
+        for file_name in file_names:
+          files.append(os.path.relpath(os.path.join(dir_path, file_name),
+                                       top))
+    else:
+      files = [filename for filename in os.listdir(top) if
+               os.path.isfile(os.path.join(top, filename))]
+    return sorted(files)
+
+  dirs_to_list = ['']
+  while dirs_to_list:
+    relative_dir = dirs_to_list.pop()
+    for entry in scandir(os.path.join(top, relative_dir)):
+      path = os.path.join(relative_dir, entry.name)
+      if entry.is_file():
+        files.append(path)
+      elif recursive and entry.is_dir(follow_symlinks=False):
+        dirs_to_list.append(path)
+  return sorted(files)
+
+
+def IsSqliteFile(path):
+  """Check the file header for the SQLite 3 magic string.
+
+  Results are cached until the inode, mtime or size of the file changes.
+
+  Args:
+    path: A string of the file path.
+
+  Returns:
+    A boolean of whether the file is an SQLite database.
+  """
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return False
+  key = (stat.st_ino, stat.st_mtime, stat.st_size)
+  cached = _SNIFFED.get(path)
+  if cached and cached[0] == key:
+    return cached[1]
+
+  is_db = False
+  if stat.st_size >= len(SQLITE_MAGIC):
+    try:
+      db_file = open(path, 'rb')
+      try:
+        is_db = db_file.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+      finally:
+        db_file.close()
+    except IOError, err:
+      print 'cannot determine file type %s' % str(err)
+  _SNIFFED[path] = (key, is_db)
+  return is_db
 
 
-def GetDbFiles(no_suffix):
+def GetDbFiles(no_suffix, recursive=False, workers=SNIFF_WORKERS,
+               catalog=None):
   """Get a list of database files from the current working directory.
 
   Args:
     no_suffix: A boolean to indicate if sqlite files might not have extensions.
+    recursive: A boolean to indicate if sub directories are searched too.
+    workers: An int of the files whose header is read at once.
+    catalog: A SchemaCatalog keeping the file checks between runs, or None.
   
   Returns:
     db_files: A list of sqlite database files to query.
   """
-  if no_suffix:
-    files_to_query = os.listdir(os.getcwd())
-  else:
-    files_to_query = [filename for filename in os.listdir(os.getcwd()) if
+  files_to_query = ListFiles(os.curdir, recursive)
+  if not no_suffix:
+    files_to_query = [filename for filename in files_to_query if
                       filename.endswith('%s' % DATABASE_SUFFIX)]
+  known = {}
+  if catalog:
+    known = catalog.Sniffed(files_to_query)
+    for a_file, sniffed in known.iteritems():
+      _SNIFFED.setdefault(a_file, sniffed)
+
+  if workers > 1 and len(files_to_query) > 1:
+    pool = ThreadPool(min(workers, len(files_to_query)))
+    try:
+      file_checks = pool.map(IsSqliteFile, files_to_query)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    file_checks = map(IsSqliteFile, files_to_query)
+
+  if catalog:
+    catalog.SaveSniffed([(a_file, _SNIFFED[a_file]) for a_file in
+                         files_to_query if a_file in _SNIFFED and
+                         _SNIFFED[a_file] != known.get(a_file)])
 
   db_files = []
-  for a_file in files_to_query:
-    try:
-      output = subprocess.Popen('/usr/bin/file %s' % a_file, shell=True,
-                                stdout=subprocess.PIPE).communicate()[0]
-    except OSError:
-      print 'cannot determine file type'
-      output = ''
-    except ValueError:
-      print 'cannot determine file type'
-      output = ''
-    except Exception, err:
-      print 'cannot determine file type %s' % str(err)
-      output = ''
-    file_results = output.rstrip('\n')
-    if re.search(r'(s|S)(q|Q)(l|L)ite', file_results):
+  for a_file, is_db in zip(files_to_query, file_checks):
+    if is_db:
       db_files.append(a_file)
   return db_files
  
 
-def PrintSchema(db_files):
+def ReadSchema(db_file):
+  """Read the schema of a database.
+
+  Args:
+    db_file: A string of the database file.
+
+  Returns:
+    schema_version: An int of the schema_version pragma, None on failure.
+    objects: A list of (type, name, tbl_name, sql) tuples from sqlite_master.
+    columns: A list of (table, cid, name, type, notnull, pk) tuples.
+  """
+  try:
+    conn = sqlite3.connect('%s' % db_file)
+    try:
+      schema_version = conn.execute('PRAGMA schema_version').fetchone()[0]
+      objects = conn.execute('SELECT type, name, tbl_name, sql FROM '
+                             'sqlite_master').fetchall()
+      columns = []
+      for object_type, name, _, _ in objects:
+        if object_type == 'table':
+          for row in conn.execute('PRAGMA table_info(%s)' % QuoteName(name)):
+            columns.append((name,) + tuple(row[:4]) + (row[5],))
+    finally:
+      conn.close()
+  except sqlite3.Error:
+    return None, [], []
+  return schema_version, objects, columns
+
+
+class SchemaCatalog(object):
+  """Cache the table, column and index metadata of many databases.
+
+  The catalog is itself an SQLite database. A file whose mtime and size are
+  unchanged is not opened at all, and one whose schema_version pragma is
+  unchanged keeps its entries, so once warm a search across hundreds of
+  databases is a single query.
+  """
+
+  def __init__(self, catalog_path=CATALOG_DB):
+    """Open the catalog, creating it if needed.
+
+    Args:
+      catalog_path: A string of the catalog database file.
+
+    Raises:
+      sqlite3.Error: The catalog could not be opened or created.
+    """
+    self.conn = sqlite3.connect(catalog_path)
+    try:
+      self.conn.executescript(CATALOG_SCHEMA)
+    except sqlite3.Error:
+      self.conn.close()
+      raise
+
+  def Refresh(self, db_files, workers=SNIFF_WORKERS):
+    """Bring the entries of a set of databases up to date.
+
+    Args:
+      db_files: A list of sqlite database files.
+      workers: An int of the schemas read at once.
+
+    Returns:
+      failed: A list of the database files that could not be read.
+    """
+    stale = []
+    for db_file in db_files:
+      path = os.path.abspath(db_file)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        stale.append((db_file, path, 0, 0))
+        continue
+      cached = self.conn.execute('SELECT mtime, size FROM files WHERE '
+                                 'path = ?', (path,)).fetchone()
+      if cached != (stat.st_mtime, stat.st_size):
+        stale.append((db_file, path, stat.st_mtime, stat.st_size))
+    if not stale:
+      return []
+
+    stale_files = [db_file for db_file, _, _, _ in stale]
+    if workers > 1 and len(stale) > 1:
+      pool = ThreadPool(min(workers, len(stale)))
+      try:
+        schemas = pool.map(ReadSchema, stale_files)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      schemas = map(ReadSchema, stale_files)
+
+    failed = []
+    with self.conn:
+      for (db_file, path, mtime, size), (schema_version, objects,
+                                         columns) in zip(stale, schemas):
+        if schema_version is None:
+          failed.append(db_file)
+          self.Forget(path)
+          continue
+        cached = self.conn.execute('SELECT schema_version FROM files WHERE '
+                                   'path = ?', (path,)).fetchone()
+        if cached and cached[0] == schema_version:
+          # only the data changed
+          self.conn.execute('UPDATE files SET mtime = ?, size = ? WHERE '
+                            'path = ?', (mtime, size, path))
+          continue
+        self.Forget(path)
+        self.conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                          (path, mtime, size, schema_version))
+        self.conn.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?)',
+                              [(path,) + tuple(row) for row in objects])
+        self.conn.executemany('INSERT INTO columns VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?)',
+                              [(path,) + row for row in columns])
+    return failed
+
+  def Forget(self, path):
+    """Drop the entries of a database.
+
+    Args:
+      path: A string of the absolute database path.
+    """
+    for table in ('files', 'objects', 'columns'):
+      self.conn.execute('DELETE FROM %s WHERE path = ?' % table, (path,))
+
+  def Query(self, db_files, sql_command, params=()):
+    """Run a query over the entries of a set of databases.
+
+    The query sees a temporary wanted table of (path, db_file) to join on.
+
+    Args:
+      db_files: A list of sqlite database files.
+      sql_command: A string of the SQL command.
+      params: A tuple of the query parameters.
+
+    Returns:
+      A list of tuple of the results.
+    """
+    self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted '
+                      '(path TEXT PRIMARY KEY, db_file TEXT)')
+    self.conn.execute('DELETE FROM wanted')
+    self.conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?, ?)',
+                          [(os.path.abspath(db_file), db_file)
+                           for db_file in db_files])
+    return self.conn.execute(sql_command, params).fetchall()
+
+  def Objects(self, db_file):
+    """List the objects of a database.
+
+    Args:
+      db_file: A string of the database file.
+
+    Returns:
+      A list of (type, name, sql) tuples in sqlite_master order.
+    """
+    return self.conn.execute('SELECT type, name, sql FROM objects WHERE '
+                             'path = ? ORDER BY rowid',
+                             (os.path.abspath(db_file),)).fetchall()
+
+  def FindTables(self, db_files, pattern):
+    """Find the databases holding a table.
+
+    Args:
+      db_files: A list of sqlite database files.
+      pattern: A string of the table name, a LIKE pattern.
+
+    Returns:
+      A list of (database file, table) tuples.
+    """
+    return self.Query(db_files, 'SELECT w.db_file, o.name FROM wanted w '
+                      'JOIN objects o ON o.path = w.path WHERE o.type = '
+                      "'table' AND o.name LIKE ? ORDER BY w.db_file, o.name",
+                      (pattern,))
+
+  def FindColumns(self, db_files, pattern):
+    """Find the databases holding a column.
+
+    Args:
+      db_files: A list of sqlite database files.
+      pattern: A string of the column name, a LIKE pattern.
+
+    Returns:
+      A list of (database file, table, column, type) tuples.
+    """
+    return self.Query(db_files, 'SELECT w.db_file, c.table_name, c.name, '
+                      'c.type FROM wanted w JOIN columns c ON c.path = '
+                      'w.path WHERE c.name LIKE ? ORDER BY w.db_file, '
+                      'c.table_name, c.cid', (pattern,))
+
+  def Sniffed(self, files):
+    """Look up the remembered file type checks of IsSqliteFile.
+
+    A catalog that cannot be read remembers nothing, so every file is
+    sniffed again.
+
+    Args:
+      files: A list of file paths.
+
+    Returns:
+      A dict of file path -> ((inode, mtime, size), whether the file is an
+      SQLite database), as kept in _SNIFFED.
+    """
+    try:
+      rows = self.Query(files, 'SELECT w.db_file, s.inode, s.mtime, s.size, '
+                        's.is_db FROM wanted w JOIN sniffed s ON s.path = '
+                        'w.path')
+    except sqlite3.Error:
+      return {}
+    return dict([(a_file, ((inode, mtime, size), bool(is_db)))
+                 for a_file, inode, mtime, size, is_db in rows])
+
+  def SaveSniffed(self, checks):
+    """Remember file type checks for the next run.
+
+    A catalog another run holds locked is left alone, the checks are only a
+    cache.
+
+    Args:
+      checks: A list of (file path, _SNIFFED entry) tuples.
+    """
+    if not checks:
+      return
+    try:
+      with self.conn:
+        self.conn.executemany('INSERT OR REPLACE INTO sniffed VALUES '
+                              '(?, ?, ?, ?, ?)',
+                              [(os.path.abspath(a_file), inode, mtime, size,
+                                int(is_db)) for a_file, ((inode, mtime, size),
+                                                         is_db) in checks])
+    except sqlite3.Error:
+      pass
+
+  def Close(self):
+    """Close the catalog."""
+    self.conn.close()
+
+
+def PrintSchema(db_files, catalog=None):
   """Print to the screen each database schema.
 
   Args:
     db_files: A list of sqlite database files to print metadata for.
+    catalog: A SchemaCatalog to read the schemas from, None to read each
+      database directly.
   """
+  if catalog:
+    try:
+      failed = catalog.Refresh(db_files)
+    except sqlite3.Error:
+      # the catalog is not writable, so read each database directly
+      catalog = None
+  if catalog:
+    for db_file in db_files:
+      if db_file in failed:
+        print 'could not open %s' % db_file
+        continue
+      print '%s' % db_file
+      for data_type, object_name, object_data in catalog.Objects(db_file):
+        if data_type == 'table':
+          print '%s\n  %s' % (object_name, object_data)
+    return
+
   for db_file in db_files:
     try:
       conn = sqlite3.connect('%s' % db_file)
@@ -81,74 +519,1162 @@ def PrintSchema(db_files):
   return
 
 
-def ProcessSql(db_files, sql_command, term_width):
+def IterRows(cursor, batch_size=FETCH_ROWS, profile=None):
+  """Pull the rows off a cursor a batch at a time.
+
+  Args:
+    cursor: An sqlite3.Cursor of an executed SQL command.
+    batch_size: An int of the rows fetched at once.
+    profile: A dict from NewProfile to add the fetch time to, None to skip.
+
+  Yields:
+    A tuple per row.
+  """
+  while True:
+    if profile is None:
+      rows = cursor.fetchmany(batch_size)
+    else:
+      start = time.time()
+      rows = cursor.fetchmany(batch_size)
+      profile['fetch'] += time.time() - start
+      profile['rows'] += len(rows)
+    if not rows:
+      break
+    for row in rows:
+      yield row
+
+
+def SpillRows(rows, spill_file, batch_size=FETCH_ROWS):
+  """Write rows to a file as a stream of pickled batches.
+
+  Args:
+    rows: An iterable of tuple of the SQL results.
+    spill_file: A file object to write to.
+    batch_size: An int of the rows pickled together.
+
+  Returns:
+    row_count: An int of the rows written.
+  """
+  row_count = 0
+  while True:
+    # blobs come back as buffers, which do not pickle
+    batch = [tuple([str(x) if isinstance(x, buffer) else x for x in line])
+             for line in itertools.islice(rows, batch_size)]
+    if not batch:
+      break
+    # length prefixed, so reading back takes two reads per batch
+    pickled = cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+    spill_file.write(struct.pack('!I', len(pickled)))
+    spill_file.write(pickled)
+    row_count += len(batch)
+  return row_count
+
+
+def ReadSpill(spill, keep_open=False):
+  """Read back the rows written by SpillRows.
+
+  Args:
+    spill: A file object, or a string of a file path removed once read.
+    keep_open: A boolean to leave the file object open for another read.
+
+  Yields:
+    A tuple per row.
+  """
+  if isinstance(spill, basestring):
+    spill_path = spill
+    spill = open(spill_path, 'rb')
+    os.unlink(spill_path)
+  try:
+    spill.seek(0)
+    while True:
+      header = spill.read(4)
+      if not header:
+        break
+      batch = cPickle.loads(spill.read(struct.unpack('!I', header)[0]))
+      for row in batch:
+        yield row
+  finally:
+    if not keep_open:
+      spill.close()
+
+
+def UriFilenames():
+  """Check if SQLite reads file: URIs as database names.
+
+  Python 2 has no way to ask for URIs per connection, so they only work when
+  SQLite was built with them turned on.
+
+  Returns:
+    A boolean of whether file: URIs are understood.
+  """
+  global _URI_FILENAMES
+  if _URI_FILENAMES is None:
+    conn = sqlite3.connect(':memory:')
+    try:
+      options = [row[0] for row in conn.execute('PRAGMA compile_options')]
+    finally:
+      conn.close()
+    _URI_FILENAMES = 'USE_URI' in options or 'USE_URI=1' in options
+  return _URI_FILENAMES
+
+
+def DbUri(db_file, open_mode):
+  """Build the URI opening a database read only.
+
+  Args:
+    db_file: A string of the database file.
+    open_mode: A string of OPEN_READ_ONLY or OPEN_IMMUTABLE.
+
+  Returns:
+    A string of the file: URI.
+  """
+  uri = 'file:%s?mode=ro' % urllib.quote(os.path.abspath(db_file))
+  if open_mode == OPEN_IMMUTABLE:
+    uri += '&immutable=1'
+  return uri
+
+
+def OpenDb(db_file, open_mode=OPEN_READ_WRITE, **kwargs):
+  """Open a database for querying.
+
+  Read only databases are opened with a mode=ro URI where SQLite allows it,
+  so no write lock is ever taken, and get a memory map and larger page cache
+  for scanning. Immutable ones also skip locking altogether, which is only
+  safe when nothing writes to the file.
+
+  Args:
+    db_file: A string of the database file.
+    open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or OPEN_IMMUTABLE.
+    kwargs: The other arguments of sqlite3.connect.
+
+  Returns:
+    conn: An sqlite3.Connection.
+  """
+  if open_mode == OPEN_READ_WRITE:
+    return sqlite3.connect('%s' % db_file, **kwargs)
+  if UriFilenames():
+    conn = sqlite3.connect(DbUri(db_file, open_mode), **kwargs)
+  else:
+    conn = sqlite3.connect('%s' % db_file, **kwargs)
+  try:
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute('PRAGMA cache_size = -%d' % CACHE_KIB)
+    conn.execute('PRAGMA mmap_size = %d' % MMAP_BYTES)
+  except:
+    conn.close()
+    raise
+  return conn
+
+
+def NewProfile():
+  """Start the profile of a query on one database.
+
+  Returns:
+    A dict of the seconds spent in each of PROFILE_PHASES, the rows
+    returned, the query plan steps, the tables they read in full and
+    whether the query failed.
+  """
+  profile = dict([(phase, 0.0) for phase in PROFILE_PHASES])
+  profile.update(rows=0, plan=[], scans=[], error=False)
+  return profile
+
+
+def ExplainSql(conn, sql_command):
+  """Ask SQLite how it would run an SQL command.
+
+  Args:
+    conn: An sqlite3.Connection to the database.
+    sql_command: A string of the SQL command.
+
+  Returns:
+    A list of strings of the EXPLAIN QUERY PLAN steps, empty if there is
+    no plan.
+  """
+  try:
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN %s' %
+                                            sql_command)]
+  except (sqlite3.Error, sqlite3.Warning):
+    return []
+
+
+def TableAliases(sql_command):
+  """Map the aliases an SQL command gives its tables back to the tables.
+
+  Args:
+    sql_command: A string of the SQL command.
+
+  Returns:
+    A dict of lower case alias -> table name.
+  """
+  aliases = {}
+  for table, alias in TABLE_ALIAS.findall(sql_command):
+    if alias.upper() not in NOT_ALIASES:
+      aliases[alias.strip('"').lower()] = table.strip('"')
+  return aliases
+
+
+def FullScans(plan, tables=None, aliases=None):
+  """Find the tables a query plan reads in full.
+
+  SQLite 3.36 and later name a table by its alias in the plan, so names
+  that are not tables are looked up in aliases, and labelled as an alias
+  when they are not found there either.
+
+  Args:
+    plan: A list of strings of the EXPLAIN QUERY PLAN steps.
+    tables: A set of the lower case table names of the database, None to
+      take every name as a table.
+    aliases: A dict of lower case alias -> table name from TableAliases.
+
+  Returns:
+    A list of strings of the table names.
+  """
+  aliases = aliases or {}
+  scans = []
+  for step in plan:
+    match = FULL_SCAN.match(step)
+    if not match or match.group(1) in ('CONSTANT', 'SUBQUERY'):
+      continue
+    name = match.group(1)
+    if tables is None or name.lower() in tables:
+      scans.append(name)
+    elif aliases.get(name.lower(), '').lower() in tables:
+      scans.append(aliases[name.lower()])
+    else:
+      scans.append('%s (alias)' % name)
+  return scans
+
+
+def ExecuteSql(db_file, sql_command, connections=None,
+               open_mode=OPEN_READ_WRITE, profile=None):
+  """Open a database and execute an SQL command on it.
+
+  Args:
+    db_file: A string of the database file.
+    sql_command: A string of the SQL command.
+    connections: A dict of database file -> sqlite3.Connection to reuse and
+      keep open, None to open a connection just for this command.
+    open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or OPEN_IMMUTABLE.
+    profile: A dict from NewProfile to add the open and execute times and
+      query plan to, None to skip.
+
+  Returns:
+    conn: An sqlite3.Connection to commit and close once the rows are read.
+    cursor: An sqlite3.Cursor to fetch the rows from.
+  """
+  start = time.time()
+  if connections is None:
+    conn = OpenDb(db_file, open_mode)
+  elif db_file in connections:
+    conn = connections[db_file]
+  else:
+    conn = OpenDb(db_file, open_mode, cached_statements=STATEMENT_CACHE)
+    connections[db_file] = conn
+  try:
+    if profile is not None:
+      profile['open'] += time.time() - start
+      profile['plan'] = ExplainSql(conn, sql_command)
+      if profile['plan']:
+        tables = set([name.lower() for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")])
+        profile['scans'] = FullScans(profile['plan'], tables,
+                                     TableAliases(sql_command))
+      start = time.time()
+    cursor = conn.cursor()
+    cursor.execute(sql_command)
+    if profile is not None:
+      # SQLite runs the query up to its first row here
+      profile['execute'] += time.time() - start
+  except:
+    if connections is None:
+      conn.close()
+    raise
+  return conn, cursor
+
+
+def SqlErrorMessage(db_file, err):
+  """Explain why an SQL command failed.
+
+  Args:
+    db_file: A string of the database file.
+    err: The exception raised.
+
+  Returns:
+    A string of the error message.
+  """
+  if isinstance(err, sqlite3.OperationalError):
+    return ('command failed. quote your arguments or escape special chars. '
+            '(%s)' % err)
+  return 'command failed. could not open %s (%s)' % (db_file, err)
+
+
+def RunSql(job):
+  """Run an SQL command against one database and spill the results.
+
+  Args:
+    job: A tuple of the database file, the SQL command, a string of the
+      directory the results go to as a named file, for another process to
+      read, or None to keep them in this one, a string of the open mode and
+      a boolean to profile the query.
+
+  Returns:
+    db_file: A string of the database file.
+    spill: A file object or file path for ReadSpill, None on failure.
+    error: A string of what went wrong, None on success.
+    seconds: A float of the time taken.
+    row_count: An int of the rows returned.
+    profile: A dict from NewProfile, None when not profiling.
+  """
+  db_file, sql_command, spill_dir, open_mode, profile = job
+  named = spill_dir is not None
+  profile = NewProfile() if profile else None
+  start = time.time()
+  if named:
+    spill = tempfile.NamedTemporaryFile(dir=spill_dir, delete=False)
+  else:
+    spill = tempfile.SpooledTemporaryFile(SPILL_BYTES)
+  try:
+    conn, cursor = ExecuteSql(db_file, sql_command, open_mode=open_mode,
+                              profile=profile)
+    try:
+      row_count = SpillRows(IterRows(cursor, profile=profile), spill)
+      conn.commit()
+    finally:
+      conn.close()
+  except Exception, err:
+    spill.close()
+    if named:
+      os.unlink(spill.name)
+    if profile is not None:
+      profile['error'] = True
+    return (db_file, None, SqlErrorMessage(db_file, err), time.time() - start,
+            0, profile)
+  if named:
+    spill.close()
+    spill = spill.name
+  return db_file, spill, None, time.time() - start, row_count, profile
+
+
+def ProcessSql(db_files, sql_command, term_width, jobs=1, processes=False,
+               timing=False, sample_size=SAMPLE_ROWS, two_pass=False,
+               connections=None, open_mode=OPEN_READ_WRITE, profile=False):
   """Process an SQL command against the database.
 
+  With one job the rows stream straight from the cursor to the screen. With
+  more the databases are queried in parallel, each spilling its rows to a
+  temporary file, and the results are printed in db_files order. Only
+  QUERY_LOOKAHEAD times jobs databases run ahead of the one being printed,
+  which bounds the spilled results held in memory. A database that fails is
+  reported and skipped without stopping the others.
+
   Args:
     db_files: A list of sqlite database files to print metadata for.
     sql_command: A string of the SQL command.
     term_width: An int of the expected terminal width.
+    jobs: An int of the databases queried at once.
+    processes: A boolean to query in worker processes instead of threads,
+      for CPU heavy queries.
+    timing: A boolean to print the rows and time taken per database.
+    sample_size: An int of the rows sampled to size the columns.
+    two_pass: A boolean to size the columns from every row instead.
+    connections: A dict of database file -> sqlite3.Connection to reuse and
+      keep open, None to open a connection per query. Queries run one
+      database at a time when given.
+    open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or OPEN_IMMUTABLE.
+    profile: A boolean to print where the time went and the query plan per
+      database, then a summary across them.
   """
+  profiles = []
+  if jobs > 1 and len(db_files) > 1 and connections is None:
+    # spills not yet printed are left behind by an interrupted run
+    spill_dir = processes and tempfile.mkdtemp(prefix='db_spill_') or None
+    sql_jobs = [(db_file, sql_command, spill_dir, open_mode, profile)
+                for db_file in db_files]
+    workers = min(jobs, len(db_files))
+    if processes:
+      pool = multiprocessing.Pool(workers)
+    else:
+      pool = ThreadPool(workers)
+    try:
+      # imap would run every query ahead of a slow printer
+      sql_jobs = iter(sql_jobs)
+      pending = collections.deque(
+          [pool.apply_async(RunSql, (sql_job,)) for sql_job in
+           itertools.islice(sql_jobs, QUERY_LOOKAHEAD * workers)])
+      while pending:
+        (db_file, spill, error, seconds, row_count,
+         db_profile) = pending.popleft().get()
+        for sql_job in itertools.islice(sql_jobs, 1):
+          pending.append(pool.apply_async(RunSql, (sql_job,)))
+        print '%s' % db_file
+        if error:
+          print error
+        else:
+          start = time.time()
+          PrintSqlResults(ReadSpill(spill), term_width, sample_size,
+                          two_pass)
+          if db_profile:
+            db_profile['format'] = time.time() - start
+        if db_profile:
+          PrintProfile(db_profile)
+          profiles.append((db_file, db_profile))
+        elif timing:
+          PrintTiming(error, row_count, seconds)
+    finally:
+      try:
+        pool.close()
+        pool.join()
+      finally:
+        if spill_dir:
+          shutil.rmtree(spill_dir, ignore_errors=True)
+    if profile:
+      PrintProfileSummary(profiles)
+    return
+
   for db_file in db_files:
+    start = time.time()
+    db_profile = NewProfile() if profile else None
     try:
-      conn = sqlite3.connect('%s' % db_file)
-      with conn:
-        cursor = conn.cursor()
-        cursor.execute(sql_command)
-    except sqlite3.OperationalError:
-      print 'command failed. quote your arguments or escape special chars.'
-      continue
-    except:
-      print 'command failed. could not open %s' % db_file
+      conn, cursor = ExecuteSql(db_file, sql_command, connections,
+                                open_mode, db_profile)
+    except Exception, err:
+      print '%s' % db_file
+      print SqlErrorMessage(db_file, err)
+      if db_profile:
+        db_profile['error'] = True
+        PrintProfile(db_profile)
+        profiles.append((db_file, db_profile))
+      elif timing:
+        PrintTiming(True, 0, time.time() - start)
       continue
     print '%s' % db_file
-    sql_results = cursor.fetchall()
-    PrintSqlResults(sql_results, term_width)
+    print_start = time.time()
+    try:
+      row_count = PrintSqlResults(IterRows(cursor, profile=db_profile),
+                                  term_width, sample_size, two_pass)
+      conn.commit()
+    except sqlite3.Error, err:
+      # the rows are only computed as they are fetched
+      print SqlErrorMessage(db_file, err)
+      if db_profile:
+        db_profile['error'] = True
+        db_profile['format'] = (time.time() - print_start -
+                                db_profile['fetch'])
+        PrintProfile(db_profile)
+        profiles.append((db_file, db_profile))
+      elif timing:
+        PrintTiming(True, 0, time.time() - start)
+      continue
+    finally:
+      if connections is None:
+        conn.close()
+    if db_profile:
+      # the rows are fetched as they are printed
+      db_profile['format'] = (time.time() - print_start -
+                              db_profile['fetch'])
+      PrintProfile(db_profile)
+      profiles.append((db_file, db_profile))
+    elif timing:
+      PrintTiming(False, row_count, time.time() - start)
+  if profile:
+    PrintProfileSummary(profiles)
   return
 
 
-def PrintSqlResults(sql_results, readable_length):
-  """Print the SQL results as friendly as the terminal width permits.
+def QuoteName(name):
+  """Quote an SQL identifier.
+
+  Args:
+    name: A string of a table or column name.
+
+  Returns:
+    A string of the quoted identifier.
+  """
+  return '"%s"' % name.replace('"', '""')
+
+
+def SourceColumn(columns):
+  """Name the column holding the database file so it clashes with no other.
+
+  Args:
+    columns: A list of the column names already in use.
+
+  Returns:
+    A string of SOURCE_COLUMN, or of SOURCE_COLUMN_1, SOURCE_COLUMN_2 and so
+    on when that is taken.
+  """
+  # SQLite compares column names without regard to case
+  taken = set([column.lower() for column in columns])
+  name = SOURCE_COLUMN
+  suffix = 0
+  while name.lower() in taken:
+    suffix += 1
+    name = '%s_%d' % (SOURCE_COLUMN, suffix)
+  return name
+
+
+def GatherTables(conn, schema, db_file, sql_command, table_columns):
+  """Copy the rows of the tables an SQL command names out of one database.
+
+  Each table lands in a temporary table of the same name, which shadows the
+  attached ones, with SOURCE_COLUMN holding the database file. A table with
+  a column of that name already gets the name SourceColumn picks instead.
 
   Args:
-    sql_results: A list of tuple of the SQL results.
+    conn: An sqlite3.Connection with the database attached.
+    schema: A string of the name the database is attached as.
+    db_file: A string of the database file.
+    sql_command: A string of the SQL command.
+    table_columns: A dict of table -> list of column names, filled in as the
+      temporary tables are created.
+  """
+  cursor = conn.execute("SELECT name FROM %s.sqlite_master WHERE type = "
+                        "'table' AND name NOT LIKE 'sqlite_%%'" % schema)
+  for (table,) in cursor.fetchall():
+    if not re.search(r'\b%s\b' % re.escape(table), sql_command, re.I):
+      continue
+    table_info = conn.execute('PRAGMA %s.table_info(%s)' % (
+        schema, QuoteName(table))).fetchall()
+    if table not in table_columns:
+      table_columns[table] = [row[1] for row in table_info]
+      source_column = SourceColumn(table_columns[table])
+      if source_column != SOURCE_COLUMN:
+        print >> sys.stderr, 'table %s has a %s column, using %s instead' % (
+            table, SOURCE_COLUMN, source_column)
+      conn.execute('CREATE TEMP TABLE %s (%s)' % (QuoteName(table), ', '.join(
+          [QuoteName(source_column)] + ['%s %s' % (QuoteName(row[1]), row[2])
+                                        for row in table_info])))
+    # SQLite would read a missing quoted column as a string literal
+    missing = set(table_columns[table]) - set([row[1] for row in table_info])
+    if missing:
+      raise sqlite3.OperationalError('table %s has no column %s' % (
+          table, ', '.join(sorted(missing))))
+    column_names = ', '.join([QuoteName(column)
+                              for column in table_columns[table]])
+    conn.execute('INSERT INTO temp.%s SELECT ?, %s FROM %s.%s' % (
+        QuoteName(table), column_names, schema, QuoteName(table)), (db_file,))
+
+
+def FederateSql(db_files, sql_command, term_width, timing=False,
+                sample_size=SAMPLE_ROWS, two_pass=False,
+                open_mode=OPEN_READ_WRITE):
+  """Process one SQL command across the rows of every database.
+
+  The tables the command names are gathered from every database into
+  temporary tables tagged with a SOURCE_COLUMN, so a single query does the
+  joins, GROUP BY and ORDER BY across all of them. Databases are attached
+  ATTACH_LIMIT at a time. A database that fails is reported and left out.
+
+  Args:
+    db_files: A list of sqlite database files to query.
+    sql_command: A string of the SQL command, read only.
     term_width: An int of the expected terminal width.
+    timing: A boolean to print the rows and time taken.
+    sample_size: An int of the rows sampled to size the columns.
+    two_pass: A boolean to size the columns from every row instead.
+    open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or OPEN_IMMUTABLE.
   """
-  max_length = 0
-  for line in sql_results:
-    line_length = [sum(len(str(x)) for x in line)]
-    if line_length[0] > max_length:
-      max_length = line_length[0]
- 
-  # test if line formatting should proceed
-  if max_length < readable_length:
-    max_lengths_list = []
-    for line in sql_results:
-      for element in line:
-        # initialize list elements with zero
-        max_lengths_list.append('%d' % 0)
+  start = time.time()
+  conn = sqlite3.connect(':memory:')
+  # transactions are handled by the savepoints below
+  conn.isolation_level = None
+  table_columns = {}
+  gathered = 0
+  try:
+    for batch_start in range(0, len(db_files), ATTACH_LIMIT):
+      batch = db_files[batch_start:batch_start + ATTACH_LIMIT]
+      attached = []
+      for db_file in batch:
+        schema = 'shard%d' % len(attached)
+        if open_mode != OPEN_READ_WRITE and UriFilenames():
+          db_name = DbUri(db_file, open_mode)
+        else:
+          db_name = db_file
+        try:
+          conn.execute('ATTACH DATABASE ? AS %s' % schema, (db_name,))
+        except sqlite3.Error, err:
+          print '%s' % db_file
+          print SqlErrorMessage(db_file, err)
+          continue
+        attached.append((schema, db_file))
+      for schema, db_file in attached:
+        # a database that fails half way leaves no rows behind
+        conn.execute('SAVEPOINT gather')
+        try:
+          GatherTables(conn, schema, db_file, sql_command, table_columns)
+          gathered += 1
+        except sqlite3.Error, err:
+          conn.execute('ROLLBACK TO gather')
+          print '%s' % db_file
+          print SqlErrorMessage(db_file, err)
+        conn.execute('RELEASE gather')
+      for schema, db_file in attached:
+        conn.execute('DETACH DATABASE %s' % schema)
+
+    if not table_columns:
+      print 'command failed. it names no table of the databases.'
+      return
+    print '%d databases' % gathered
+    try:
+      cursor = conn.execute(sql_command)
+    except sqlite3.Error, err:
+      print SqlErrorMessage(':memory:', err)
+      return
+    row_count = PrintSqlResults(IterRows(cursor), term_width, sample_size,
+                                two_pass)
+    if timing:
+      PrintTiming(False, row_count, time.time() - start)
+  finally:
+    conn.close()
+
+
+def OpenExport(path, compress=False):
+  """Open the file an export is written to.
+
+  Args:
+    path: A string of the file path, None or '-' for stdout.
+    compress: A boolean to gzip what is written.
+
+  Returns:
+    stream: A file object to write to.
+    closers: A list of file objects to close, in order, once done.
+  """
+  if path in (None, '-'):
+    stream = sys.stdout
+    closers = []
+  else:
+    stream = open(path, 'wb')
+    closers = [stream]
+  if compress:
+    # GzipFile is not a context manager before python 2.7
+    stream = gzip.GzipFile(fileobj=stream, mode='wb')
+    closers.insert(0, stream)
+  return stream, closers
+
+
+def ExportValue(value):
+  """Convert a column value to what an export format can hold.
+
+  Args:
+    value: A column value.
+
+  Returns:
+    The value, with text as a utf-8 string and blobs in base64.
+  """
+  if isinstance(value, buffer):
+    # the csv module stops at a NUL byte and JSON only holds text
+    return base64.b64encode(str(value))
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def ExportRows(cursor, stream, export_format, source=None, header=True):
+  """Write the rows of a cursor to a stream a batch at a time.
+
+  Args:
+    cursor: An sqlite3.Cursor of an executed SQL command.
+    stream: A file object to write to.
+    export_format: A string of one of EXPORT_FORMATS.
+    source: A string of the database file written first, in a column named
+      by SourceColumn, None to leave it out.
+    header: A boolean to write the column names first, for CSV and TSV.
+
+  Returns:
+    row_count: An int of the rows written.
+  """
+  if cursor.description is None:
+    # not a query
+    return 0
+  columns = [description[0] for description in cursor.description]
+  prefix = ()
+  if source is not None:
+    columns.insert(0, SourceColumn(columns))
+    prefix = (source,)
+
+  row_count = 0
+  if export_format == EXPORT_NDJSON:
+    keys = [json.dumps(column) + ': ' for column in columns]
+    while True:
+      rows = cursor.fetchmany(FETCH_ROWS)
+      if not rows:
+        break
+      # built by hand to keep the column order
+      stream.write(''.join(['{%s}\n' % ', '.join([
+          key + json.dumps(ExportValue(value))
+          for key, value in zip(keys, prefix + row)]) for row in rows]))
+      row_count += len(rows)
+    return row_count
+
+  delimiter = export_format == EXPORT_TSV and '\t' or ','
+  writer = csv.writer(stream, delimiter=delimiter, lineterminator='\n')
+  if header:
+    writer.writerow([ExportValue(column)
+                     for column in columns])
+  while True:
+    rows = cursor.fetchmany(FETCH_ROWS)
+    if not rows:
       break
+    writer.writerows([[ExportValue(value)
+                       for value in prefix + row] for row in rows])
+    row_count += len(rows)
+  return row_count
 
-    for line in sql_results:
-      index_num = 0
-      for element in line:
-        string_length = len(str(element))
-        if string_length > int(max_lengths_list[index_num]):
-          max_lengths_list[index_num] = string_length
-        index_num += 1
 
-    list_of_spacers = []
-    for max_len in max_lengths_list:
-      list_of_spacers.append('%' + '%s' % max_len + 's')
-    string_spacer = ' '.join(list_of_spacers)
+def ExportPath(output, db_file, export_format, compress=False):
+  """Name the file one database is exported to.
 
-    for line in sql_results:
-      print string_spacer % line
+  Args:
+    output: A string of the export directory.
+    db_file: A string of the database file.
+    export_format: A string of one of EXPORT_FORMATS.
+    compress: A boolean of whether the export is gzipped.
+
+  Returns:
+    A string of the file path, mirroring the database path under output.
+  """
+  path = os.path.join(output, '%s.%s' % (db_file, export_format))
+  if compress:
+    path += '.gz'
+  return path
+
+
+def ExportDb(job):
+  """Export the results of an SQL command on one database to its own file.
+
+  Args:
+    job: A tuple of the database file, the SQL command, a string of one of
+      EXPORT_FORMATS, the export directory, a boolean to gzip and a string
+      of the open mode.
+
+  Returns:
+    db_file: A string of the database file.
+    error: A string of what went wrong, None on success.
+    seconds: A float of the time taken.
+    row_count: An int of the rows written.
+  """
+  db_file, sql_command, export_format, output, compress, open_mode = job
+  start = time.time()
+  path = ExportPath(output, db_file, export_format, compress)
+  try:
+    conn, cursor = ExecuteSql(db_file, sql_command, open_mode=open_mode)
+    try:
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError, err:
+        # another export made it first
+        if err.errno != errno.EEXIST:
+          raise
+      stream, closers = OpenExport(path, compress)
+      try:
+        row_count = ExportRows(cursor, stream, export_format)
+      finally:
+        for closer in closers:
+          closer.close()
+      conn.commit()
+    finally:
+      conn.close()
+  except (sqlite3.Error, EnvironmentError), err:
+    return db_file, SqlErrorMessage(db_file, err), time.time() - start, 0
+  return db_file, None, time.time() - start, row_count
+
+
+def ExportSql(db_files, sql_command, export_format, output=None,
+              compress=False, partition=False, jobs=1, timing=False,
+              open_mode=OPEN_READ_WRITE):
+  """Stream the results of an SQL command on every database to a file.
 
+  Rows are fetched FETCH_ROWS at a time and written straight out, so memory
+  use stays flat however large the export. Into one file each row is led by
+  a SOURCE_COLUMN naming its database and CSV or TSV get a single header.
+  Partitioned, each database goes to its own file under output, jobs at a
+  time. Progress and errors go to stderr, leaving stdout to the data.
+
+  Args:
+    db_files: A list of sqlite database files to query.
+    sql_command: A string of the SQL command.
+    export_format: A string of one of EXPORT_FORMATS.
+    output: A string of the file path, None or '-' for stdout, or of the
+      directory when partitioned.
+    compress: A boolean to gzip the files written.
+    partition: A boolean to write a file per database.
+    jobs: An int of the databases exported at once when partitioned.
+    timing: A boolean to print the rows and time taken per database.
+    open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or OPEN_IMMUTABLE.
+  """
+  if partition:
+    export_jobs = [(db_file, sql_command, export_format, output, compress,
+                    open_mode) for db_file in db_files]
+    if jobs > 1 and len(db_files) > 1:
+      pool = ThreadPool(min(jobs, len(db_files)))
+      exports = pool.imap(ExportDb, export_jobs)
+    else:
+      pool = None
+      exports = itertools.imap(ExportDb, export_jobs)
+    try:
+      for db_file, error, seconds, row_count in exports:
+        if error:
+          print >> sys.stderr, '%s' % db_file
+          print >> sys.stderr, error
+        elif timing:
+          print >> sys.stderr, ExportPath(output, db_file, export_format,
+                                          compress)
+        if timing:
+          PrintTiming(error, row_count, seconds, sys.stderr)
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+    return
+
+  stream, closers = OpenExport(output, compress)
+  header = True
+  try:
+    for db_file in db_files:
+      start = time.time()
+      try:
+        conn, cursor = ExecuteSql(db_file, sql_command, open_mode=open_mode)
+      except Exception, err:
+        print >> sys.stderr, '%s' % db_file
+        print >> sys.stderr, SqlErrorMessage(db_file, err)
+        if timing:
+          PrintTiming(True, 0, time.time() - start, sys.stderr)
+        continue
+      try:
+        row_count = ExportRows(cursor, stream, export_format, db_file, header)
+        conn.commit()
+      except sqlite3.Error, err:
+        print >> sys.stderr, '%s' % db_file
+        print >> sys.stderr, SqlErrorMessage(db_file, err)
+        if timing:
+          PrintTiming(True, 0, time.time() - start, sys.stderr)
+        continue
+      finally:
+        # the header went out with the first query, even a failed one
+        header = header and cursor.description is None
+        conn.close()
+      if timing:
+        print >> sys.stderr, '%s' % db_file
+        PrintTiming(False, row_count, time.time() - start, sys.stderr)
+  finally:
+    stream.flush()
+    for closer in closers:
+      closer.close()
+
+
+class DbShell(cmd.Cmd):
+  """An interactive shell keeping every database open between commands.
+
+  Files are discovered once, connections and their prepared statements are
+  kept for the session and schemas come from the catalog, so each command
+  only costs the query itself. A line that is not a shell command is run as
+  SQL against every database.
+  """
+
+  prompt = 'db> '
+
+  def __init__(self, no_suffix, recursive, term_width, timing=False,
+               sample_size=SAMPLE_ROWS, two_pass=False,
+               catalog_path=CATALOG_DB, open_mode=OPEN_READ_WRITE):
+    """Discover the databases.
+
+    Args:
+      no_suffix: A boolean to indicate if sqlite files might not have
+        extensions.
+      recursive: A boolean to indicate if sub directories are searched too.
+      term_width: An int of the expected terminal width.
+      timing: A boolean to print the rows and time taken per database.
+      sample_size: An int of the rows sampled to size the columns.
+      two_pass: A boolean to size the columns from every row instead.
+      catalog_path: A string of the schema catalog database file.
+      open_mode: A string of OPEN_READ_WRITE, OPEN_READ_ONLY or
+        OPEN_IMMUTABLE.
+    """
+    # cmd.Cmd is an old style class
+    cmd.Cmd.__init__(self)
+    self.no_suffix = no_suffix
+    self.recursive = recursive
+    self.term_width = term_width
+    self.timing = timing
+    self.sample_size = sample_size
+    self.two_pass = two_pass
+    self.catalog_path = catalog_path
+    self.open_mode = open_mode
+    self.profile = False
+    self.catalog = None
+    self.connections = {}
+    self.db_files = []
+    self.do_rescan('')
+
+  def Catalog(self):
+    """Open the schema catalog on first use.
+
+    Returns:
+      A SchemaCatalog.
+    """
+    if self.catalog is None:
+      self.catalog = SchemaCatalog(self.catalog_path)
+    return self.catalog
+
+  def Close(self):
+    """Close every connection and the catalog."""
+    for conn in self.connections.values():
+      conn.close()
+    self.connections = {}
+    if self.catalog is not None:
+      self.catalog.Close()
+      self.catalog = None
+
+  def onecmd(self, line):
+    """Run a command, reporting what went wrong rather than leaving."""
+    try:
+      return cmd.Cmd.onecmd(self, line)
+    except KeyboardInterrupt:
+      print 'interrupted'
+    except (sqlite3.Error, sqlite3.Warning, EnvironmentError), err:
+      print 'command failed. %s' % err
+
+  def emptyline(self):
+    """Do nothing, rather than repeat the last command."""
+    pass
+
+  def default(self, line):
+    """Run a line as SQL against every database."""
+    if not self.db_files:
+      print 'no databases. try rescan.'
+      return
+    ProcessSql(self.db_files, line, self.term_width, timing=self.timing,
+               sample_size=self.sample_size, two_pass=self.two_pass,
+               connections=self.connections, open_mode=self.open_mode,
+               profile=self.profile)
+
+  def do_rescan(self, line):
+    """rescan
+    Discover the databases again, closing those that went away."""
+    try:
+      catalog = self.Catalog()
+    except sqlite3.Error:
+      catalog = None
+    self.db_files = GetDbFiles(self.no_suffix, self.recursive,
+                               catalog=catalog)
+    for db_file in set(self.connections) - set(self.db_files):
+      self.connections.pop(db_file).close()
+    print '%d databases' % len(self.db_files)
+
+  def do_files(self, line):
+    """files
+    List the databases, marking those with an open connection."""
+    for db_file in self.db_files:
+      if db_file in self.connections:
+        print '* %s' % db_file
+      else:
+        print '  %s' % db_file
+
+  def do_schema(self, line):
+    """schema
+    Print each database schema."""
+    try:
+      catalog = self.Catalog()
+    except sqlite3.Error:
+      catalog = None
+    PrintSchema(self.db_files, catalog)
+
+  def do_find_table(self, line):
+    """find_table PATTERN
+    List the databases with a table matching a LIKE pattern."""
+    if not line:
+      print 'usage: find_table PATTERN'
+      return
+    catalog = self.Catalog()
+    for db_file in catalog.Refresh(self.db_files):
+      print 'could not open %s' % db_file
+    PrintSqlResults(catalog.FindTables(self.db_files, line), self.term_width)
+
+  def do_find_column(self, line):
+    """find_column PATTERN
+    List the databases with a column matching a LIKE pattern."""
+    if not line:
+      print 'usage: find_column PATTERN'
+      return
+    catalog = self.Catalog()
+    for db_file in catalog.Refresh(self.db_files):
+      print 'could not open %s' % db_file
+    PrintSqlResults(catalog.FindColumns(self.db_files, line), self.term_width)
+
+  def do_federate(self, line):
+    """federate SQL_COMMAND
+    Run one read only command over the rows of every database."""
+    if not line:
+      print 'usage: federate SQL_COMMAND'
+      return
+    FederateSql(self.db_files, line, self.term_width, self.timing,
+                self.sample_size, self.two_pass, self.open_mode)
+
+  def do_timing(self, line):
+    """timing [on|off]
+    Print the rows returned and time taken per database."""
+    if line in ('on', 'off'):
+      self.timing = line == 'on'
+    elif line:
+      print 'usage: timing [on|off]'
+      return
+    print 'timing is %s' % ('on' if self.timing else 'off')
+
+  def do_profile(self, line):
+    """profile [on|off]
+    Print where the time went and the query plan per database."""
+    if line in ('on', 'off'):
+      self.profile = line == 'on'
+    elif line:
+      print 'usage: profile [on|off]'
+      return
+    print 'profile is %s' % ('on' if self.profile else 'off')
+
+  def do_quit(self, line):
+    """quit
+    Leave the shell."""
+    return True
+
+  def do_EOF(self, line):
+    """Leave the shell on end of input."""
+    print
+    return True
+
+
+def PrintProfile(profile, stream=None):
+  """Print where the time of a query on one database went.
+
+  Args:
+    profile: A dict from NewProfile.
+    stream: A file object to print to, None for stdout.
+  """
+  stream = stream or sys.stdout
+  phases = ' '.join(['%s %.3f' % (phase, profile[phase])
+                     for phase in PROFILE_PHASES])
+  if profile['error']:
+    print >> stream, 'failed. %s seconds' % phases
+  else:
+    print >> stream, '%d rows. %s seconds' % (profile['rows'], phases)
+  for step in profile['plan']:
+    print >> stream, '  plan: %s' % step
+  for table in profile['scans']:
+    print >> stream, '  full table scan of %s' % table
+
+
+def PrintProfileSummary(profiles, stream=None):
+  """Sum up the profiles of a query across databases.
+
+  Args:
+    profiles: A list of (database file, dict from NewProfile) tuples.
+    stream: A file object to print to, None for stdout.
+  """
+  stream = stream or sys.stdout
+  if not profiles:
+    return
+  failed = len([1 for _, profile in profiles if profile['error']])
+  # table -> databases reading it in full
+  scanned = {}
+  for db_file, profile in profiles:
+    for table in profile['scans']:
+      databases = scanned.setdefault(table, [])
+      if db_file not in databases:
+        databases.append(db_file)
+  print >> stream, 'profile of %d databases, %d failed, %d rows' % (
+      len(profiles), failed, sum([profile['rows'] for _, profile in profiles]))
+
+  totals = [(sum([profile[phase] for phase in PROFILE_PHASES]), db_file)
+            for db_file, profile in profiles]
+  print >> stream, '  %-8s %9s %9s  %s' % ('phase', 'total', 'max', 'slowest')
+  for phase in PROFILE_PHASES + ('all',):
+    if phase == 'all':
+      seconds = totals
+    else:
+      seconds = [(profile[phase], db_file) for db_file, profile in profiles]
+    slowest = max(seconds)
+    print >> stream, '  %-8s %9.3f %9.3f  %s' % (
+        phase, sum([second for second, _ in seconds]), slowest[0],
+        slowest[1])
+
+  print >> stream, 'slowest databases'
+  totals.sort(reverse=True)
+  for seconds, db_file in totals[:PROFILE_SLOWEST]:
+    print >> stream, '  %9.3f  %s' % (seconds, db_file)
+  if scanned:
+    print >> stream, 'full table scans, which an index may avoid'
+    for table in sorted(scanned):
+      print >> stream, '  %s in %d of %d databases: %s' % (
+          table, len(scanned[table]), len(profiles),
+          ', '.join(scanned[table]))
+
+
+def PrintTiming(error, row_count, seconds, stream=None):
+  """Print how a database query went.
+
+  Args:
+    error: A boolean of whether the query failed.
+    row_count: An int of the rows returned.
+    seconds: A float of the time taken.
+    stream: A file object to print to, None for stdout.
+  """
+  stream = stream or sys.stdout
+  if error:
+    print >> stream, 'failed in %.3f seconds' % seconds
+  else:
+    print >> stream, '%d rows in %.3f seconds' % (row_count, seconds)
+
+
+def PrintSqlResults(sql_results, readable_length, sample_size=SAMPLE_ROWS,
+                    two_pass=False):
+  """Print the SQL results as friendly as the terminal width permits.
+
+  Rows are printed as they arrive, so memory use stays flat however many
+  there are. Column widths come from the first sample_size rows, or with
+  two_pass from every row after spilling them to a temporary file.
+
+  Args:
+    sql_results: An iterable of tuple of the SQL results.
+    term_width: An int of the expected terminal width.
+    sample_size: An int of the rows sampled to size the columns.
+    two_pass: A boolean to size the columns from every row instead.
+
+  Returns:
+    row_count: An int of the rows printed.
+  """
+  sql_results = iter(sql_results)
+  if two_pass:
+    sample = []
+    spill_file = tempfile.TemporaryFile()
+    SpillRows(sql_results, spill_file)
+    sized_rows = ReadSpill(spill_file, keep_open=True)
   else:
-    for line in sql_results:
+    sample = list(itertools.islice(sql_results, sample_size))
+    sized_rows = sample
+
+  max_length = 0
+  max_lengths_list = []
+  for line in sized_rows:
+    if not max_lengths_list:
+      # initialize list elements with zero
+      max_lengths_list = [0] * len(line)
+    string_lengths = [len(str(element)) for element in line]
+    max_length = max(max_length, sum(string_lengths))
+    for index_num, string_length in enumerate(string_lengths):
+      if string_length > max_lengths_list[index_num]:
+        max_lengths_list[index_num] = string_length
+  if two_pass:
+    sql_results = ReadSpill(spill_file)
+
+  string_spacer = ' '.join('%' + '%s' % max_len + 's'
+                           for max_len in max_lengths_list)
+  row_count = 0
+  # test if line formatting should proceed
+  for line in itertools.chain(sample, sql_results):
+    if max_length < readable_length:
+      print string_spacer % line
+    else:
       print line
-  return
+    row_count += 1
+  return row_count
 
 
 def main():
@@ -163,22 +1689,141 @@ Print data from SQLite databases in the current directory.
                     help=('Print all database schema info.'))
   parser.add_option('-n', '--no-suffix', dest='no_suffix', default=False,
                     action='store_true',
-                    help=('Ignore the default suffix and use the shell to '
-                          'determine if each file is an SQLite database.'))
+                    help=('Ignore the default suffix and check the header of '
+                          'each file to determine if it is an SQLite '
+                          'database.'))
+  parser.add_option('-r', '--recursive', dest='recursive', default=False,
+                    action='store_true',
+                    help=('Search sub directories for databases too.'))
+  parser.add_option('--find-table', dest='find_table',
+                    help=('List the databases with a table of this name, a '
+                          'LIKE pattern, from the schema catalog.'))
+  parser.add_option('--find-column', dest='find_column',
+                    help=('List the databases with a column of this name, a '
+                          'LIKE pattern, from the schema catalog.'))
+  parser.add_option('--catalog', dest='catalog', default=CATALOG_DB,
+                    help=('The schema catalog caching the schema of every '
+                          'database seen. Defaults to %s.' % CATALOG_DB))
+  parser.add_option('-i', '--interactive', dest='interactive', default=False,
+                    action='store_true',
+                    help=('Start a shell keeping every database open, running '
+                          'each line as SQL. Type help for its commands.'))
+  parser.add_option('-F', '--federate', dest='federate', default=False,
+                    action='store_true',
+                    help=('Run the command once over the rows of every '
+                          'database, tagged with a %s column, instead of '
+                          'once per database. Read only.' % SOURCE_COLUMN))
+  parser.add_option('-e', '--export', dest='export_format',
+                    choices=EXPORT_FORMATS,
+                    help=('Stream the results as %s instead of printing '
+                          'them.' % ', '.join(EXPORT_FORMATS)))
+  parser.add_option('-o', '--output', dest='output',
+                    help=('The file to export to, stdout by default, or the '
+                          'directory with --partition.'))
+  parser.add_option('-z', '--gzip', dest='compress', default=False,
+                    action='store_true',
+                    help=('Gzip the export. Implied by an output ending in '
+                          '.gz.'))
+  parser.add_option('--partition', dest='partition', default=False,
+                    action='store_true',
+                    help=('Export each database to its own file under the '
+                          'output directory.'))
+  parser.add_option('-R', '--read-only', dest='open_mode',
+                    default=OPEN_READ_WRITE, action='store_const',
+                    const=OPEN_READ_ONLY,
+                    help=('Open the databases read only, memory mapped and '
+                          'never taking a write lock, for scanning large '
+                          'databases others may be writing to.'))
+  parser.add_option('--immutable', dest='open_mode', action='store_const',
+                    const=OPEN_IMMUTABLE,
+                    help=('Open the databases read only without any locking. '
+                          'Only safe when nothing writes to them.'))
+  parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                    default=QUERY_WORKERS,
+                    help=('The databases queried at once. Defaults to %d.' %
+                          QUERY_WORKERS))
+  parser.add_option('-P', '--processes', dest='processes', default=False,
+                    action='store_true',
+                    help=('Query in worker processes instead of threads, for '
+                          'CPU heavy queries.'))
+  parser.add_option('-t', '--timing', dest='timing', default=False,
+                    action='store_true',
+                    help=('Print the rows returned and time taken per '
+                          'database.'))
+  parser.add_option('--profile', dest='profile', default=False,
+                    action='store_true',
+                    help=('Print the open, execute, fetch and format time, '
+                          'rows and query plan per database, flagging full '
+                          'table scans, then a summary across them.'))
+  parser.add_option('--sample', dest='sample_size', type='int',
+                    default=SAMPLE_ROWS,
+                    help=('The rows sampled to size the columns. Defaults to '
+                          '%d.' % SAMPLE_ROWS))
+  parser.add_option('--two-pass', dest='two_pass', default=False,
+                    action='store_true',
+                    help=('Spill the results to a temporary file and size '
+                          'the columns from every row.'))
   parser.add_option('-w', '--width', dest='term_width', type='int',
                     default=200, help=('The max characters your terminal width '
                                        'will support.'))
   (options, args) = parser.parse_args() 
   sql_command = ' '.join(args)
+
+  if options.interactive:
+    shell = DbShell(options.no_suffix, options.recursive, options.term_width,
+                    options.timing, options.sample_size, options.two_pass,
+                    options.catalog, options.open_mode)
+    try:
+      shell.cmdloop()
+    finally:
+      shell.Close()
+    return
  
-  db_files = GetDbFiles(options.no_suffix)
-  if db_files:
+  try:
+    catalog = SchemaCatalog(options.catalog)
+  except sqlite3.Error, err:
+    # only the find options need the catalog
+    catalog = None
+    catalog_error = err
+  try:
+    db_files = GetDbFiles(options.no_suffix, options.recursive,
+                          catalog=catalog)
+    if not db_files:
+      return
     if options.list_schema:
-      PrintSchema(db_files)
-    else:
-      if sql_command:
-        ProcessSql(db_files, sql_command, options.term_width)
-
+      PrintSchema(db_files, catalog)
+    elif options.find_table or options.find_column:
+      if not catalog:
+        print 'could not open the schema catalog %s (%s)' % (options.catalog,
+                                                            catalog_error)
+        return
+      for db_file in catalog.Refresh(db_files):
+        print 'could not open %s' % db_file
+      if options.find_table:
+        PrintSqlResults(catalog.FindTables(db_files, options.find_table),
+                        options.term_width)
+      if options.find_column:
+        PrintSqlResults(catalog.FindColumns(db_files, options.find_column),
+                        options.term_width)
+    elif sql_command and options.export_format:
+      if options.partition and not options.output:
+        parser.error('--partition needs an --output directory')
+      ExportSql(db_files, sql_command, options.export_format,
+                options.output, options.compress or
+                (options.output or '').endswith('.gz'), options.partition,
+                options.jobs, options.timing, options.open_mode)
+    elif sql_command and options.federate:
+      FederateSql(db_files, sql_command, options.term_width,
+                  options.timing, options.sample_size, options.two_pass,
+                  options.open_mode)
+    elif sql_command:
+      ProcessSql(db_files, sql_command, options.term_width, options.jobs,
+                 options.processes, options.timing, options.sample_size,
+                 options.two_pass, open_mode=options.open_mode,
+                 profile=options.profile)
+  finally:
+    if catalog:
+      catalog.Close()
 
 if __name__ == '__main__':
   main()
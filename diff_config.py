@@ -10,189 +10,1912 @@ configurations differ from machine to machine.
 """
 
 import os
+import sys
+import json
 import re
+import time
+import array
+import bisect
+import errno
+import random
+import select
+import socket
 import argparse
+import resource
+import collections
 import shutil
 import getpass
 import tempfile
 import subprocess
+import pipes
+import hashlib
+import sqlite3
+import tarfile
 import threading
 import Queue
 import pexpect
 
 # TODO: webify the user interface
 
+OUTLIER_UNIQUE = 'unique'
+OUTLIER_MINORITY = 'minority'
+OUTLIER_MAJORITY = 'majority'
+OUTLIER_MODES = (OUTLIER_UNIQUE, OUTLIER_MINORITY, OUTLIER_MAJORITY)
 
-class ParseConfigFile(threading.Thread):
+OUTPUT_TEXT = 'text'
+OUTPUT_NDJSON = 'ndjson'
+OUTPUT_JSON = 'json'
+OUTPUTS = (OUTPUT_TEXT, OUTPUT_NDJSON, OUTPUT_JSON)
+
+SSH_BANNER = 'SSH-2.0-OpenSSH_'
+PROBE_SSH = 'ssh'
+PROBE_NON_SSH = 'non-ssh'
+PROBE_UNREACHABLE = 'unreachable'
+
+# prints "<sha256> <path>" for every readable file given to it
+DIGEST_COMMAND = ('for f in %s; do [ -f "$f" ] && [ -r "$f" ] && echo '
+                  '"$( (sha256sum || shasum -a 256 || openssl dgst -sha256) '
+                  '<"$f" 2>/dev/null | sed \'s/^.*= //; s/ .*//\') $f"; '
+                  'done; true')
+CACHE_DIR = os.path.expanduser('~/.cache/diff_config')
+SNAPSHOT_DB = os.path.expanduser('~/.diff_config_snapshots.db')
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+  host TEXT NOT NULL,
+  path TEXT NOT NULL,
+  digest TEXT NOT NULL,
+  taken REAL NOT NULL,
+  seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_path_host
+  ON snapshots (path, host, taken);
+CREATE TABLE IF NOT EXISTS variants (
+  digest TEXT PRIMARY KEY,
+  delimiter_error INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS variant_lines (
+  digest TEXT NOT NULL,
+  line INTEGER NOT NULL,
+  section TEXT NOT NULL,
+  directive TEXT NOT NULL,
+  value TEXT NOT NULL,
+  PRIMARY KEY (digest, line)
+);
+"""
+
+# seconds an idle background master connection outlives its last use, so
+# one left behind by an interrupted run still goes away
+CONTROL_PERSIST = 60
+
+# machine -> (family, sockaddr) answers from LookupHost, None when the
+# machine did not resolve
+_RESOLVED = {}
+RESOLVE_WORKERS = 64
+
+FORMAT_AUTO = 'auto'
+FORMAT_KV = 'kv'
+FORMAT_INI = 'ini'
+FORMAT_SSHD = 'sshd'
+FORMATS = (FORMAT_AUTO, FORMAT_KV, FORMAT_INI, FORMAT_SSHD)
+DEFAULT_DELIMITERS = {FORMAT_KV: ' ', FORMAT_INI: '=', FORMAT_SSHD: ' '}
+SSHD_FILES = ('sshd_config', 'ssh_config')
+INI_SUFFIXES = ('.ini', '.cfg', '.cnf')
+
+MEANINGFUL_LINE = re.compile(r'[a-zA-Z0-9$]')
+APPENDED_COMMENTS = re.compile(r'(?P<config>[^#;/!]*)[^#;/!]([;]|[#]|[!]'
+                               '|[/]{2}).*')
+INI_SECTION = re.compile(r'\[(?P<section>[^\]]*)\]')
+INI_SECTION_LINE = re.compile(r'^[ \t]*\[[^\]\n]*\][ \t]*$', re.MULTILINE)
+INI_KEY_VALUE_LINE = re.compile(r'^[ \t]*[\w.\-]+[ \t]*=', re.MULTILINE)
+# bytes of a file looked at to guess its syntax
+DETECT_BYTES = 65536
+
+
+class ParseConfigFile(object):
   """Parse out a configuration file."""
 
-  def __init__(self, delimiter, tmp_dir, conf_instance):
-    """Initializes the class with some constants.
+  def __init__(self, delimiter, mach_name, content, conf_format=FORMAT_KV):
+    """Initializes the class with some constants.
+
+    Args:
+      delimiter: A string of the key/value delimiter, None for the format's
+        default.
+      mach_name: A string of the machine name.
+      content: A string of the raw config file bytes.
+      conf_format: A string of FORMAT_KV, FORMAT_INI or FORMAT_SSHD.
+    """
+    if delimiter is None:
+      delimiter = DEFAULT_DELIMITERS[conf_format]
+    self.delimiter = delimiter
+    self.mach_name = mach_name
+    self.content = content
+    self.conf_format = conf_format
+    self.section = ''
+    self.effective_config = []
+    self.delimiter_error = False
+
+  def ParseFile(self):
+    """Parse the configuration file."""
+    store = self.effective_config.append
+    tokenize = self.Tokenize
+    for line in IterLines(self.content):
+      token = tokenize(line)
+      if token:
+        store(token)
+
+  def Tokenize(self, line):
+    """Split the wheat from the chaff in a single pass over the line.
+
+    Args:
+      line: A string of text.
+
+    Returns:
+      A (section, directive, value) tuple, or None for lines that aren't
+      meaningful configuration or only open a new section.
+    """
+    line = line.strip().replace('\t', ' ')
+    if self.conf_format == FORMAT_INI:
+      section_match = INI_SECTION.match(line)
+      if section_match:
+        self.section = section_match.group('section').strip()
+        return None
+    # eliminate lines that aren't meaningful configuration
+    if not MEANINGFUL_LINE.match(line):
+      return None
+    directive, found, detail = line.partition(self.delimiter)
+    if not found:
+      # this might happen when a delimiter is not provided
+      self.delimiter_error = True
+    # strip out where comments append the configuration text
+    if ('#' in detail or ';' in detail or '!' in detail or
+        '//' in detail):
+      comment_match = APPENDED_COMMENTS.match(detail)
+      if comment_match:
+        detail = comment_match.group('config')
+    detail = detail.strip()
+    if self.conf_format == FORMAT_INI:
+      directive = directive.strip()
+    elif self.conf_format == FORMAT_SSHD and directive.lower() == 'match':
+      # a Match block runs until the next Match line
+      self.section = '%s %s' % (directive, detail)
+      return None
+    return self.section, directive, detail
+
+  def Parse(self):
+    """Parse the configuration file and hand back the parser."""
+    self.ParseFile()
+    # the raw bytes are not needed once the config is parsed
+    self.content = ''
+    return self
+
+
+class TransportError(Exception):
+  """A remote operation failed in a way worth retrying."""
+
+
+class AuthError(Exception):
+  """A machine refused the login, which retrying will not change."""
+
+
+def LookupHost(mach):
+  """Look up the first stream address for a machine.
+
+  Args:
+    mach: A string of the machine name.
+
+  Returns:
+    A tuple of the address family and socket address, or None.
+  """
+  try:
+    addr_info = socket.getaddrinfo(mach, None, 0, socket.SOCK_STREAM)
+  except socket.error:
+    return None
+  family, _, _, _, sockaddr = addr_info[0]
+  return family, sockaddr
+
+
+def ResolveHost(mach, port=22):
+  """Look up the first stream address for a machine, remembering the answer.
+
+  Args:
+    mach: A string of the machine name.
+    port: An int of the TCP port.
+
+  Returns:
+    A tuple of the address family and socket address, or None.
+  """
+  if mach not in _RESOLVED:
+    _RESOLVED[mach] = LookupHost(mach)
+  address = _RESOLVED[mach]
+  if address is None:
+    return None
+  family, sockaddr = address
+  return family, (sockaddr[0], port) + tuple(sockaddr[2:])
+
+
+def ResolveHosts(machines, timeout=3.0, workers=RESOLVE_WORKERS):
+  """Look up many machines at once, remembering the answers.
+
+  getaddrinfo blocks and cannot be interrupted, so the lookups run on daemon
+  threads. A machine still unanswered timeout seconds after its lookup began
+  counts as not resolving, and its thread is replaced, so a few slow or dead
+  names hold up neither the rest nor the caller.
+
+  Args:
+    machines: A list of machine names.
+    timeout: A float of the seconds allowed per lookup.
+    workers: An int of the lookups run at once.
+  """
+  todo = collections.deque(mach for mach in collections.OrderedDict.fromkeys(
+      machines) if mach not in _RESOLVED)
+  if not todo:
+    return
+  condition = threading.Condition()
+  # machine -> time its lookup began, until it is answered or times out
+  started = {}
+
+  def Worker():
+    while True:
+      with condition:
+        if not todo:
+          return
+        mach = todo.popleft()
+        started[mach] = time.time()
+      address = LookupHost(mach)
+      with condition:
+        if started.pop(mach, None) is None:
+          # timed out, and another thread has taken over
+          return
+        _RESOLVED[mach] = address
+        condition.notify()
+
+  def StartWorker():
+    worker = threading.Thread(target=Worker)
+    worker.daemon = True
+    worker.start()
+
+  for _ in range(min(workers, len(todo))):
+    StartWorker()
+  with condition:
+    while todo or started:
+      now = time.time()
+      for mach, start in started.items():
+        if now - start >= timeout:
+          del started[mach]
+          _RESOLVED[mach] = None
+          if todo:
+            StartWorker()
+      if started:
+        condition.wait(max(0.01, min(started.values()) + timeout - now))
+      elif todo:
+        condition.wait(0.05)
+
+
+def SubnetKey(mach):
+  """Group a machine by the network it lives on.
+
+  Args:
+    mach: A string of the machine name.
+
+  Returns:
+    A string of the /24 for IPv4, the /64 for IPv6 or the machine name when
+    it does not resolve.
+  """
+  address = ResolveHost(mach)
+  if address is None:
+    return mach
+  family, sockaddr = address
+  if family == socket.AF_INET:
+    return '%s.0/24' % sockaddr[0].rsplit('.', 1)[0]
+  packed = socket.inet_pton(family, sockaddr[0])
+  return '%s/64' % socket.inet_ntop(family, packed[:8] + '\0' * 8)
+
+
+class HostScheduler(object):
+  """Bound and adapt how many remote operations run at once.
+
+  A global window caps the operations in flight and a fixed limit caps those
+  sharing a subnet, or a jump host when one is in use, while local
+  directories all share one. The window grows by one with every quick
+  success and halves, at most once per target latency, when operations fail
+  or the average latency climbs past the target.
+  """
+
+  def __init__(self, limit=32, group_limit=8, min_limit=1,
+               target_latency=2.0, retries=2, backoff=0.5, jump_host='',
+               local=False):
+    """Initializes the class with some constants.
+
+    Args:
+      limit: An int of the most operations in flight.
+      group_limit: An int of the most operations in flight per group.
+      min_limit: An int of the smallest the window shrinks to.
+      target_latency: A float of the seconds an operation should take.
+      retries: An int of the retries after a failed operation.
+      backoff: A float of the seconds waited before the first retry.
+      jump_host: A string of the jump host every operation goes through.
+      local: A boolean of whether the machines are local directories, which
+        all share one group.
+    """
+    self.limit = max(1, limit)
+    self.group_limit = max(1, group_limit)
+    self.min_limit = max(1, min(min_limit, self.limit))
+    self.target_latency = target_latency
+    self.retries = retries
+    self.backoff = backoff
+    self.jump_host = jump_host
+    self.local = local
+    # start a quarter open and let the successes widen it
+    self.window = float(max(self.min_limit, self.limit // 4))
+    self.latency = None
+    self.last_decrease = 0
+    self.active = 0
+    self.group_active = collections.Counter()
+    self.groups = {}
+    self.condition = threading.Condition()
+
+  def GroupKey(self, mach):
+    """Work out which group a machine belongs to.
+
+    Args:
+      mach: A string of the machine name.
+
+    Returns:
+      A string of the group.
+    """
+    if self.local:
+      return 'local'
+    if self.jump_host:
+      return 'jump:%s' % self.jump_host
+    if mach not in self.groups:
+      self.groups[mach] = SubnetKey(mach)
+    return self.groups[mach]
+
+  def Saturated(self):
+    """Tell whether the global window is full.
+
+    Returns:
+      A boolean.
+    """
+    return self.active >= int(self.window)
+
+  def TryAcquire(self, mach):
+    """Take a slot for a machine without waiting.
+
+    Args:
+      mach: A string of the machine name.
+
+    Returns:
+      A boolean of whether the slot was taken.
+    """
+    group = self.GroupKey(mach)
+    with self.condition:
+      if self.Saturated() or self.group_active[group] >= self.group_limit:
+        return False
+      self.active += 1
+      self.group_active[group] += 1
+      return True
+
+  def Acquire(self, mach):
+    """Take a slot for a machine, waiting for one to free up.
+
+    Args:
+      mach: A string of the machine name.
+    """
+    group = self.GroupKey(mach)
+    with self.condition:
+      while (self.Saturated() or
+             self.group_active[group] >= self.group_limit):
+        self.condition.wait()
+      self.active += 1
+      self.group_active[group] += 1
+
+  def Release(self, mach, latency=None, ok=True):
+    """Hand back a slot and adapt the window to how the operation went.
+
+    Args:
+      mach: A string of the machine name.
+      latency: A float of the seconds the operation took, None to ignore.
+      ok: A boolean of whether the operation succeeded.
+    """
+    group = self.GroupKey(mach)
+    with self.condition:
+      self.active -= 1
+      self.group_active[group] -= 1
+      if ok and latency is not None:
+        if self.latency is None:
+          self.latency = latency
+        else:
+          self.latency = 0.8 * self.latency + 0.2 * latency
+      now = time.time()
+      if not ok or (self.latency or 0) > self.target_latency:
+        if now - self.last_decrease > self.target_latency:
+          self.window = max(self.min_limit, self.window / 2)
+          self.last_decrease = now
+      elif latency is not None:
+        self.window = min(self.limit, self.window + 1)
+      self.condition.notify_all()
+
+  def Backoff(self, attempt):
+    """Work out how long to wait before retrying.
+
+    Args:
+      attempt: An int of the attempts made so far, starting at zero.
+
+    Returns:
+      A float of seconds.
+    """
+    return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+  def Run(self, mach, operation):
+    """Run an operation against a machine in a slot, retrying on failure.
+
+    Args:
+      mach: A string of the machine name.
+      operation: A function taking no arguments.
+
+    Returns:
+      What the operation returned.
+
+    Raises:
+      TransportError: The operation failed on every attempt.
+    """
+    for attempt in range(self.retries + 1):
+      self.Acquire(mach)
+      start = time.time()
+      latency = None
+      try:
+        try:
+          result = operation()
+        except TransportError:
+          if attempt == self.retries:
+            raise
+        else:
+          latency = time.time() - start
+          return result
+      finally:
+        # any other error is not retried but must still free the slot
+        self.Release(mach, latency, ok=latency is not None)
+      time.sleep(self.Backoff(attempt))
+
+
+class Timings(object):
+  """Collect phase and per-machine timings of a run.
+
+  Phases are summed for the summary table, every span is also kept as a
+  Chrome trace event, and the per-machine counters show which machines were
+  slow to fetch or parse. Spans may be added from any thread.
+  """
+
+  def __init__(self):
+    """Initializes an empty collection."""
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.phases = collections.OrderedDict()
+    # machine -> Counter of fetch, queue_wait, bytes, files, fetch_errors,
+    # parse, lines
+    self.machines = collections.defaultdict(collections.Counter)
+    self.events = []
+
+  def Span(self, name, category, start, end, async_id=None, **args):
+    """Record a span as a trace event.
+
+    Args:
+      name: A string naming the span.
+      category: A string grouping similar spans.
+      start: A float of the epoch time the span began.
+      end: A float of the epoch time the span ended.
+      async_id: A string of an id for spans overlapping on one thread, which
+        get a lane of their own in the trace viewer.
+      args: Extra values shown with the span.
+    """
+    timestamp = int((start - self.start) * 1e6)
+    duration = int((end - start) * 1e6)
+    event = {'name': name, 'cat': category, 'pid': os.getpid(),
+             'tid': threading.current_thread().ident, 'args': args}
+    if async_id is None:
+      event.update(ph='X', ts=timestamp, dur=duration)
+      events = [event]
+    else:
+      end_event = dict(event, ph='e', ts=timestamp + duration, id=async_id)
+      event.update(ph='b', ts=timestamp, id=async_id)
+      events = [event, end_event]
+    with self.lock:
+      self.events.extend(events)
+
+  def Phase(self, name, start, end):
+    """Record a phase of the run.
+
+    Args:
+      name: A string naming the phase.
+      start: A float of the epoch time the phase began.
+      end: A float of the epoch time the phase ended.
+    """
+    self.Span(name, 'phase', start, end)
+    with self.lock:
+      self.phases[name] = self.phases.get(name, 0) + end - start
+
+  def Count(self, mach, **counts):
+    """Add to the counters of a machine.
+
+    Args:
+      mach: A string of the machine name.
+      counts: Numbers to add, keyed by counter name.
+    """
+    with self.lock:
+      self.machines[mach].update(counts)
+
+  def Fetch(self, mach, queued, start, end, files, error=None):
+    """Record a machine's fetch.
+
+    Args:
+      mach: A string of the machine name.
+      queued: A float of the epoch time the machine was queued.
+      start: A float of the epoch time the first attempt began.
+      end: A float of the epoch time the fetch ended.
+      files: A dict of file path -> file content, None for a file unchanged
+        since it was last seen, or None when the fetch failed; see error.
+      error: A string of why the fetch failed, None when it succeeded.
+    """
+    files = files or {}
+    fetched = sum(len(content) for content in files.itervalues()
+                  if content is not None)
+    args = {}
+    if error is not None:
+      args['error'] = error
+    self.Span(mach, 'fetch', start, end, files=len(files), bytes=fetched,
+              queue_wait=start - queued, **args)
+    self.Count(mach, fetch=end - start, queue_wait=start - queued,
+               bytes=fetched, files=len(files),
+               fetch_errors=int(error is not None))
+
+  def Parse(self, mach, configfile, start, end, content):
+    """Record the parse of one config file.
+
+    Args:
+      mach: A string of the machine name.
+      configfile: A string of the config file path.
+      start: A float of the epoch time the parse began.
+      end: A float of the epoch time the parse ended.
+      content: A string of the config file bytes.
+    """
+    lines = content.count('\n')
+    self.Span(configfile, 'parse', start, end, mach=mach, lines=lines)
+    self.Count(mach, parse=end - start, lines=lines)
+
+  def PrintSummary(self, stream, slowest=10):
+    """Print the phase table, the totals and the slowest machines.
+
+    Args:
+      stream: A file object to print to.
+      slowest: An int of the machines listed.
+    """
+    totals = collections.Counter()
+    for counts in self.machines.itervalues():
+      totals.update(counts)
+    print >> stream, '\n%-20s %9s' % ('phase', 'seconds')
+    for name, seconds in self.phases.iteritems():
+      print >> stream, '%-20s %9.3f' % (name, seconds)
+    print >> stream, '%-20s %9.3f\n' % ('total', time.time() - self.start)
+    fetched = [counts for counts in self.machines.itervalues()
+               if 'fetch' in counts]
+    if fetched:
+      print >> stream, ('fetch: %d machines, %d failed, %d files, %d bytes, '
+                        'queue wait avg %.3fs max %.3fs' % (
+                            len(fetched), totals['fetch_errors'],
+                            totals['files'], totals['bytes'],
+                            totals['queue_wait'] / len(fetched),
+                            max(counts['queue_wait'] for counts in fetched)))
+    if totals['parse']:
+      print >> stream, 'parse: %d lines in %.3fs, %d lines/sec' % (
+          totals['lines'], totals['parse'], totals['lines'] / totals['parse'])
+    ranked = sorted(self.machines.iteritems(),
+                    key=lambda item: -(item[1]['probe'] + item[1]['fetch'] +
+                                       item[1]['parse']))
+    if not ranked:
+      return
+    width = max(len('machine'), max(len(mach) for mach, _ in ranked[:slowest]))
+    print >> stream, '\n%-*s %9s %9s %9s %9s %9s %6s' % (
+        width, 'machine', 'probe', 'wait', 'fetch', 'bytes', 'parse',
+        'failed')
+    for mach, counts in ranked[:slowest]:
+      print >> stream, ('%-*s %9.3f %9.3f %9.3f %9d %9.3f %6s' % (
+          width, mach, counts['probe'], counts['queue_wait'], counts['fetch'],
+          counts['bytes'], counts['parse'],
+          counts['fetch_errors'] and 'yes' or '')).rstrip()
+
+  def WriteTrace(self, path):
+    """Write the spans as a Chrome trace file.
+
+    Args:
+      path: A string of the file to write, loadable in chrome://tracing or
+        Perfetto.
+    """
+    with open(path, 'w') as trace_file:
+      json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                trace_file)
+
+
+class CountingFile(object):
+  """Wrap a file object to count the bytes read through it."""
+
+  def __init__(self, fileobj):
+    """Initializes the class with some constants.
+
+    Args:
+      fileobj: A file object to read from.
+    """
+    self.fileobj = fileobj
+    self.count = 0
+
+  def read(self, size=-1):
+    data = self.fileobj.read(size)
+    self.count += len(data)
+    return data
+
+  def __iter__(self):
+    for line in self.fileobj:
+      self.count += len(line)
+      yield line
+
+
+def ReadTarStream(fileobj, paths):
+  """Split a tar stream back into the files that were requested.
+
+  Args:
+    fileobj: A file object positioned at the start of a tar stream.
+    paths: A list of the absolute file paths that were archived.
+
+  Returns:
+    files: A dict of file path -> file content.
+  """
+  # tar drops the leading slash from the member names it writes
+  member_paths = dict((os.path.normpath(path).lstrip('/'), path)
+                      for path in paths)
+  files = {}
+  try:
+    archive = tarfile.open(fileobj=fileobj, mode='r|')
+    for member in archive:
+      path = member_paths.get(os.path.normpath(member.name).lstrip('/'))
+      if path and member.isfile():
+        files[path] = archive.extractfile(member).read()
+    archive.close()
+  except tarfile.TarError:
+    # nothing readable came back, or the stream was cut short
+    pass
+  return files
+
+
+def ReadDigests(fileobj, paths):
+  """Read the output of DIGEST_COMMAND.
+
+  Args:
+    fileobj: A file object of the command output.
+    paths: A list of the absolute file paths that were digested.
+
+  Returns:
+    digests: A dict of file path -> hex digest, or None for a file that
+      exists but could not be digested, e.g. with no sha256 tool on the
+      machine.
+  """
+  digests = {}
+  wanted = set(paths)
+  for line in fileobj:
+    digest, _, path = line.rstrip('\n').partition(' ')
+    if path in wanted:
+      if len(digest) == 64:
+        digests[path] = digest.lower()
+      else:
+        digests[path] = None
+  return digests
+
+
+class ContentCache(object):
+  """A local content-addressed store of fetched config files.
+
+  Files live under <cache_dir>/<first two hex digits>/<sha256>. Reading an
+  entry refreshes its mtime, which Evict treats as the last use.
+  """
+
+  def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024,
+               max_age=30 * 86400):
+    """Initializes the class with some constants.
+
+    Args:
+      cache_dir: A string of the cache directory.
+      max_bytes: An int of the most bytes kept after eviction.
+      max_age: An int of the seconds an unused entry is kept.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+
+  def EntryPath(self, digest):
+    """Build the path of a cache entry.
+
+    Args:
+      digest: A string of the sha256 hex digest.
+
+    Returns:
+      A string of the entry path.
+    """
+    return os.path.join(self.cache_dir, digest[:2], digest)
+
+  def Get(self, digest):
+    """Read an entry.
+
+    Args:
+      digest: A string of the sha256 hex digest.
+
+    Returns:
+      A string of the content, or None when it is not cached.
+    """
+    entry_path = self.EntryPath(digest)
+    try:
+      with open(entry_path, 'rb') as file_obj:
+        content = file_obj.read()
+      os.utime(entry_path, None)
+    except (IOError, OSError):
+      return None
+    return content
+
+  def Put(self, content):
+    """Store content under its digest.
+
+    Args:
+      content: A string of the file content.
+
+    Returns:
+      digest: A string of the sha256 hex digest.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    entry_path = self.EntryPath(digest)
+    if os.path.exists(entry_path):
+      return digest
+    entry_dir = os.path.dirname(entry_path)
+    try:
+      if not os.path.isdir(entry_dir):
+        os.makedirs(entry_dir)
+    except OSError:
+      # another fetch thread got there first
+      pass
+    fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+    with os.fdopen(fd, 'wb') as file_obj:
+      file_obj.write(content)
+    os.rename(tmp_path, entry_path)
+    return digest
+
+  def Evict(self):
+    """Drop stale entries, then the least recently used beyond the size cap.
+
+    Returns:
+      removed: An int of the entries removed.
+    """
+    now = time.time()
+    entries = []
+    removed = 0
+    for dir_path, _, file_names in os.walk(self.cache_dir):
+      for file_name in file_names:
+        entry_path = os.path.join(dir_path, file_name)
+        try:
+          stat_info = os.stat(entry_path)
+        except OSError:
+          continue
+        if now - stat_info.st_mtime > self.max_age:
+          os.remove(entry_path)
+          removed += 1
+        else:
+          entries.append((stat_info.st_mtime, stat_info.st_size, entry_path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+      if total_bytes <= self.max_bytes:
+        break
+      os.remove(entry_path)
+      total_bytes -= size
+      removed += 1
+    return removed
+
+
+class SshTransport(object):
+  """Pull files off remote machines with one SSH session per machine.
+
+  Each machine is logged in to once, by key or by password, and the master
+  connection is shared by every command run on it until Disconnect.
+  """
+
+  def __init__(self, user, password='', verbose=False, connect_timeout=3,
+               timeout=30, jump_host=''):
+    """Initializes the class with some constants.
+
+    Args:
+      user: A string of the user to log in as.
+      password: A string of the password, empty when SSH keys are in place.
+      verbose: A boolean of whether to print remote error messages.
+      connect_timeout: An int of the seconds allowed to connect.
+      timeout: An int of the seconds allowed per remote command.
+      jump_host: A string of the host to hop through, empty to connect
+        directly.
+    """
+    self.user = user
+    self.password = password
+    self.verbose = verbose
+    self.timeout = timeout
+    self.ssh_options = ['-o', 'ConnectTimeout=%d' % connect_timeout]
+    if jump_host:
+      self.ssh_options += ['-o', 'ProxyJump=%s' % jump_host]
+    # sockets for the multiplexed master connections
+    self.control_dir = tempfile.mkdtemp()
+    # machine -> pexpect.spawn of a password master, None for a key master
+    self.masters = {}
+    self.lock = threading.Lock()
+
+  def SshCommand(self, mach, remote_command, extra_options=()):
+    """Build an ssh command line.
+
+    Args:
+      mach: A string of the machine name.
+      remote_command: A string of the shell command to run remotely.
+      extra_options: A sequence of extra ssh arguments.
+
+    Returns:
+      A list of the ssh arguments.
+    """
+    return (['/usr/bin/ssh'] + self.ssh_options + list(extra_options) +
+            ['%s@%s' % (self.user, mach), remote_command])
+
+  def ControlPath(self, mach):
+    """Name the control socket of a machine.
+
+    Args:
+      mach: A string of the machine name.
+
+    Returns:
+      A string of a path short enough for a unix socket.
+    """
+    return os.path.join(self.control_dir,
+                        hashlib.sha1(mach).hexdigest()[:16])
+
+  def DoKeyAuth(self, mach, control_path):
+    """Open a background master connection to a machine with SSH keys.
+
+    Args:
+      mach: A string of the machine name.
+      control_path: A string of the control socket to create.
+
+    Raises:
+      TransportError: The machine could not be logged in to.
+    """
+    errors = tempfile.TemporaryFile()
+    try:
+      with open(os.devnull, 'r+') as devnull:
+        returncode = subprocess.call(
+            ['/usr/bin/ssh'] + self.ssh_options +
+            ['-o', 'BatchMode=yes', '-o', 'ControlMaster=yes',
+             '-o', 'ControlPath=%s' % control_path,
+             '-o', 'ControlPersist=%ds' % CONTROL_PERSIST,
+             '-N', '-f', '%s@%s' % (self.user, mach)],
+            stdin=devnull, stdout=devnull, stderr=errors)
+      if returncode != 0:
+        errors.seek(0)
+        raise TransportError(errors.read().strip() or 'could not log in')
+    except OSError, err:
+      raise TransportError('could not run ssh: %s' % err)
+    finally:
+      errors.close()
+
+  def DoManualAuth(self, mach, control_path):
+    """Open a master connection to a machine with the user supplied password.
+
+    Args:
+      mach: A string of the machine name.
+      control_path: A string of the control socket to create.
+
+    Returns:
+      ssh_conn: A pexpect.spawn of the master connection, or None when the
+        password was refused.
+
+    Raises:
+      TransportError: The machine could not be logged in to.
+    """
+    ssh_conn = None
+    try:
+      ssh_conn = pexpect.spawn('/usr/bin/ssh', self.ssh_options +
+                               ['-o', 'ControlMaster=yes',
+                                '-o', 'ControlPath=%s' % control_path, '-N',
+                                '%s@%s' % (self.user, mach)],
+                               timeout=self.timeout)
+      ssh_conn.expect('assword:')
+      ssh_conn.sendline(self.password)
+      deadline = time.time() + self.timeout
+      while not os.path.exists(control_path):
+        i = ssh_conn.expect(['assword:', 'ermission denied', pexpect.EOF,
+                             pexpect.TIMEOUT], timeout=0.1)
+        if i in (0, 1):
+          print 'your password failed on %s' % mach
+          ssh_conn.close(force=True)
+          return None
+        elif i == 2 or time.time() > deadline:
+          ssh_conn.close(force=True)
+          raise TransportError('could not log in')
+    except pexpect.ExceptionPexpect, err:
+      if ssh_conn:
+        ssh_conn.close(force=True)
+      raise TransportError('could not log in: %s' % err)
+    return ssh_conn
+
+  def Connect(self, mach):
+    """Log in to a machine unless a master connection is already up.
+
+    Args:
+      mach: A string of the machine name.
+
+    Returns:
+      A list of the ssh options running a command over the master
+      connection, or None when the password was refused.
+
+    Raises:
+      TransportError: The machine could not be logged in to.
+    """
+    control_path = self.ControlPath(mach)
+    with self.lock:
+      connected = mach in self.masters
+      ssh_conn = self.masters.get(mach)
+    if connected and ssh_conn is not None and not ssh_conn.isalive():
+      self.Disconnect(mach)
+      connected = False
+    if not connected:
+      if self.password:
+        ssh_conn = self.DoManualAuth(mach, control_path)
+        if ssh_conn is None:
+          return None
+      else:
+        self.DoKeyAuth(mach, control_path)
+      with self.lock:
+        self.masters[mach] = ssh_conn
+    return ['-o', 'BatchMode=yes', '-o', 'ControlMaster=no',
+            '-o', 'ControlPath=%s' % control_path]
+
+  def Disconnect(self, mach):
+    """Shut down the master connection to a machine, if there is one.
+
+    Args:
+      mach: A string of the machine name.
+    """
+    with self.lock:
+      if mach not in self.masters:
+        return
+      ssh_conn = self.masters.pop(mach)
+    with open(os.devnull, 'r+') as devnull:
+      subprocess.call(['/usr/bin/ssh', '-o',
+                       'ControlPath=%s' % self.ControlPath(mach), '-O', 'exit',
+                       '%s@%s' % (self.user, mach)],
+                      stdin=devnull, stdout=devnull, stderr=devnull)
+    if ssh_conn is not None:
+      ssh_conn.close(force=True)
+
+  def RunRemote(self, mach, remote_command, reader):
+    """Run a command on a machine and hand its output to a reader.
+
+    Args:
+      mach: A string of the machine name.
+      remote_command: A string of the Bourne shell command to run remotely.
+      reader: A function taking the stdout file object and returning a dict.
+
+    Returns:
+      The dict returned by reader.
+
+    Raises:
+      AuthError: The password was refused.
+      TransportError: ssh failed to connect, the command could not be run or
+        it timed out.
+    """
+    extra_options = self.Connect(mach)
+    if extra_options is None:
+      # an empty result would read as every file missing
+      raise AuthError('the password was refused')
+    # the login shell may be csh or tcsh, so hand the command to sh
+    remote_command = 'sh -c %s' % pipes.quote(remote_command)
+    try:
+      ssh_proc = subprocess.Popen(self.SshCommand(mach, remote_command,
+                                                  extra_options),
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+      killer = threading.Timer(self.timeout, ssh_proc.kill)
+      killer.start()
+      try:
+        stdout = CountingFile(ssh_proc.stdout)
+        results = reader(stdout)
+        error = ssh_proc.communicate()[1]
+      finally:
+        killer.cancel()
+    except OSError, err:
+      raise TransportError('could not run ssh: %s' % err)
+    if ssh_proc.returncode < 0:
+      # a retry should start over with a fresh login
+      self.Disconnect(mach)
+      raise TransportError('timed out after %d seconds' % self.timeout)
+    if error and self.verbose is True:
+      print '%s said: %s' % (mach, error.strip())
+    # ssh exits with 255 when it never got as far as the remote command
+    if ssh_proc.returncode == 255:
+      self.Disconnect(mach)
+      raise TransportError(error.strip() or 'ssh failed')
+    # tar always writes an archive and DIGEST_COMMAND exits zero, so a
+    # failure with no output means the command never got to run
+    if ssh_proc.returncode and not stdout.count:
+      raise TransportError(error.strip() or 'exited with status %d' %
+                           ssh_proc.returncode)
+    return results
+
+  def DigestFiles(self, mach, paths):
+    """Ask a machine for the sha256 digest of a set of files.
+
+    Args:
+      mach: A string of the machine name.
+      paths: A list of the absolute file paths to digest.
+
+    Returns:
+      A dict of file path -> hex digest for the files that exist, None for
+      those that could not be digested.
+    """
+    remote_command = DIGEST_COMMAND % ' '.join(pipes.quote(path)
+                                               for path in paths)
+    return self.RunRemote(mach, remote_command,
+                          lambda stdout: ReadDigests(stdout, paths))
+
+  def FetchFiles(self, mach, paths):
+    """Fetch a set of files from a machine in a single tar stream.
+
+    Args:
+      mach: A string of the machine name.
+      paths: A list of the absolute file paths to fetch.
+
+    Returns:
+      files: A dict of file path -> file content for the files that exist.
+    """
+    remote_command = 'tar chf - %s 2>/dev/null' % ' '.join(
+        pipes.quote(path) for path in paths)
+    files = self.RunRemote(mach, remote_command,
+                           lambda stdout: ReadTarStream(stdout, paths))
+    if self.verbose is True:
+      for path in paths:
+        if path not in files:
+          print 'could not read %s on %s' % (path, mach)
+    return files
+
+  def Close(self):
+    """Shut down every master connection and remove their sockets."""
+    for mach in self.masters.keys():
+      self.Disconnect(mach)
+    shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class LocalDirTransport(object):
+  """Serve files out of a local directory holding one tree per machine.
+
+  The file /etc/ssh/sshd_config of machine web1 is read from
+  <root>/web1/etc/ssh/sshd_config, which lets a directory of canned configs
+  stand in for a fleet of machines.
+  """
+
+  def __init__(self, root):
+    """Initializes the class with some constants.
+
+    Args:
+      root: A string of the directory holding the machine trees.
+    """
+    self.root = root
+
+  def Machines(self):
+    """List the machines available under the root.
+
+    Returns:
+      A sorted list of machine names.
+    """
+    return sorted(name for name in os.listdir(self.root)
+                  if os.path.isdir(os.path.join(self.root, name)))
+
+  def DigestFiles(self, mach, paths):
+    """Work out the sha256 digest of a set of files in a machine's tree.
+
+    Args:
+      mach: A string of the machine name.
+      paths: A list of the absolute file paths to digest.
+
+    Returns:
+      A dict of file path -> hex digest for the files that exist.
+    """
+    return dict((path, hashlib.sha256(content).hexdigest())
+                for path, content in self.FetchFiles(mach, paths).iteritems())
+
+  def FetchFiles(self, mach, paths):
+    """Read a set of files from a machine's tree.
+
+    Args:
+      mach: A string of the machine name.
+      paths: A list of the absolute file paths to fetch.
+
+    Returns:
+      files: A dict of file path -> file content for the files that exist.
+    """
+    files = {}
+    for path in paths:
+      local_path = os.path.join(self.root, mach, path.lstrip('/'))
+      try:
+        with open(local_path, 'rb') as file_obj:
+          files[path] = file_obj.read()
+      except IOError:
+        continue
+    return files
+
+  def Disconnect(self, mach):
+    """Nothing to shut down."""
+
+  def Close(self):
+    """Nothing to clean up."""
+
+
+class FetchRemoteConfig(threading.Thread):
+  """Gather remote configuration files onto the localhost."""
+
+  def __init__(self, queue, transport, configfiles, parse_queue, scheduler,
+               cache=None, known_digests=None, timings=None):
+    """Initializes the class with some constants.
+
+    Args:
+      queue: A Queue.Queue of (machine name, epoch time queued) tuples.
+      transport: An SshTransport or LocalDirTransport to fetch with.
+      configfiles: A list of the absolute config file paths.
+      parse_queue: A Queue.Queue fed with (config file, machine, content)
+        tuples as files land, content being None for files matching
+        known_digests. Once a machine is done (None, machine, error) follows,
+        error being None unless the fetch failed.
+      scheduler: A HostScheduler every fetch runs under.
+      cache: A ContentCache to check before fetching, or None.
+      known_digests: A dict of (machine, config file) -> digest of content
+        that need not be fetched again, or None.
+      timings: A Timings to record each fetch in, or None.
+    """
+    threading.Thread.__init__(self)
+    self.queue = queue
+    self.transport = transport
+    self.configfiles = configfiles
+    self.parse_queue = parse_queue
+    self.scheduler = scheduler
+    self.cache = cache
+    self.known_digests = known_digests
+    self.timings = timings
+    self.fetch_start = None
+
+  def RetrieveByDigest(self):
+    """Fetch only the files whose remote digest is not known or cached yet.
+
+    Returns:
+      files: A dict of file path -> file content, or None when the content
+        matches known_digests.
+    """
+    files = {}
+    wanted = []
+    digests = self.transport.DigestFiles(self.mach, self.configfiles)
+    for configfile in self.configfiles:
+      if configfile not in digests:
+        continue
+      digest = digests[configfile]
+      if digest is None:
+        # no digest to compare, so fetch it the usual way
+        wanted.append(configfile)
+        continue
+      if (self.known_digests and
+          self.known_digests.get((self.mach, configfile)) == digest):
+        files[configfile] = None
+        continue
+      content = None
+      if self.cache:
+        content = self.cache.Get(digest)
+      if content is None:
+        wanted.append(configfile)
+      else:
+        files[configfile] = content
+    if wanted:
+      fetched = self.transport.FetchFiles(self.mach, wanted)
+      for configfile, content in fetched.iteritems():
+        if self.cache:
+          self.cache.Put(content)
+        files[configfile] = content
+    return files
+
+  def CollectFiles(self):
+    """Fetch every config file from the machine.
+
+    Returns:
+      files: A dict of file path -> file content.
+    """
+    if self.fetch_start is None:
+      self.fetch_start = time.time()
+    if self.cache or self.known_digests is not None:
+      return self.RetrieveByDigest()
+    return self.transport.FetchFiles(self.mach, self.configfiles)
+
+  def RetrieveFiles(self):
+    """Fetch every config file from the machine and queue it for parsing."""
+    self.fetch_start = None
+    begun = time.time()
+    files = None
+    error = None
+    try:
+      files = self.scheduler.Run(self.mach, self.CollectFiles)
+    except Exception, err:
+      error = str(err) or err.__class__.__name__
+      raise
+    finally:
+      # failed and timed out fetches are the slow ones worth seeing
+      if self.timings:
+        self.timings.Fetch(self.mach, self.queued, self.fetch_start or begun,
+                           time.time(), files, error)
+    for configfile in self.configfiles:
+      if configfile in files:
+        self.parse_queue.put((configfile, self.mach, files.pop(configfile)))
+
+  def run(self):
+    """The worker method."""
+    while True:
+      self.mach, self.queued = self.queue.get()
+      error = None
+      try:
+        self.RetrieveFiles()
+      except Exception, err:
+        error = str(err)
+        print >> sys.stderr, 'could not fetch config files from %s: %s' % (
+            self.mach, err)
+      finally:
+        self.transport.Disconnect(self.mach)
+      self.parse_queue.put((None, self.mach, error))
+      self.queue.task_done()
+
+
+class SnapshotStore(object):
+  """Keep the parsed configs of earlier runs in a local SQLite database.
+
+  Parsed configs are stored once per content digest. Each machine and path
+  gets a new snapshot row only when its digest changes, with a digest of ''
+  recording that the file went missing.
+  """
+
+  def __init__(self, db_path):
+    """Initializes the class with some constants.
+
+    Args:
+      db_path: A string of the SQLite database file.
+    """
+    self.conn = sqlite3.connect(db_path)
+    self.conn.executescript(SNAPSHOT_SCHEMA)
+
+  def Digests(self, path, before=None):
+    """Look up the digest each machine had for a file.
+
+    Args:
+      path: A string of the config file path.
+      before: A float of the epoch time to look back to, None for the latest.
+
+    Returns:
+      A dict of machine name -> digest.
+    """
+    if before is None:
+      before = time.time()
+    cursor = self.conn.execute(
+        'SELECT host, digest FROM snapshots AS s WHERE path = ? AND taken = '
+        '(SELECT MAX(taken) FROM snapshots WHERE host = s.host AND '
+        'path = s.path AND taken <= ?)', (path, before))
+    return dict(cursor.fetchall())
+
+  def HasVariant(self, digest):
+    """Tell whether a parsed config is stored.
+
+    Args:
+      digest: A string of the content digest.
+
+    Returns:
+      A boolean.
+    """
+    cursor = self.conn.execute('SELECT 1 FROM variants WHERE digest = ?',
+                               (digest,))
+    return cursor.fetchone() is not None
+
+  def LoadVariant(self, digest):
+    """Read back a parsed config.
+
+    Args:
+      digest: A string of the content digest.
+
+    Returns:
+      A list of (section, directive, value) tuples.
+    """
+    cursor = self.conn.execute(
+        'SELECT section, directive, value FROM variant_lines WHERE digest = ? '
+        'ORDER BY line', (digest,))
+    return [tuple(row) for row in cursor]
+
+  def SaveVariant(self, digest, effective_config, delimiter_error):
+    """Store a parsed config unless it is already stored.
+
+    Args:
+      digest: A string of the content digest.
+      effective_config: A list of (section, directive, value) tuples.
+      delimiter_error: A boolean of whether the parser hit a bad delimiter.
+    """
+    if self.HasVariant(digest):
+      return
+    self.conn.execute('INSERT INTO variants VALUES (?, ?)',
+                      (digest, int(delimiter_error)))
+    self.conn.executemany(
+        'INSERT INTO variant_lines VALUES (?, ?, ?, ?, ?)',
+        ((digest, line, section, directive, value) for line,
+         (section, directive, value) in enumerate(effective_config)))
+
+  def Record(self, host, path, digest, previous_digest=None):
+    """Record the digest a machine holds for a file.
+
+    Args:
+      host: A string of the machine name.
+      path: A string of the config file path.
+      digest: A string of the content digest, '' when the file is missing.
+      previous_digest: A string of the last recorded digest when known.
+    """
+    now = time.time()
+    if previous_digest is None:
+      previous_digest = self.Digests(path).get(host)
+    if previous_digest == digest:
+      self.conn.execute(
+          'UPDATE snapshots SET seen = ? WHERE host = ? AND path = ? AND '
+          'taken = (SELECT MAX(taken) FROM snapshots WHERE host = ? AND '
+          'path = ?)', (now, host, path, host, path))
+    else:
+      self.conn.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)',
+                        (host, path, digest, now, now))
+
+  def Close(self):
+    """Commit and close the database."""
+    self.conn.commit()
+    self.conn.close()
+
+
+class HostProber(object):
+  """Probe many machines for an SSH banner from a single poll loop.
+
+  Every machine gets a non-blocking TCP connection and the banner is read
+  in-process, so thousands of probes can be in flight without forking a
+  subprocess per machine.
+  """
+
+  def __init__(self, port=22, timeout=3.0, concurrency=512,
+               banner=SSH_BANNER, scheduler=None, timings=None):
+    """Initializes the class with some constants.
+
+    Args:
+      port: An int of the TCP port to probe.
+      timeout: A float of the seconds allowed per machine.
+      concurrency: An int of the most connections open at once.
+      banner: A string the greeting has to start with.
+      scheduler: A HostScheduler pacing the probes, defaults to a fixed
+        window of concurrency probes without retries.
+      timings: A Timings to record each probe in, or None.
+    """
+    self.port = port
+    self.timeout = timeout
+    self.concurrency = max(1, min(concurrency, MaxOpenSockets()))
+    self.banner = banner
+    if scheduler is None:
+      scheduler = HostScheduler(self.concurrency, self.concurrency,
+                                min_limit=self.concurrency, retries=0)
+    self.scheduler = scheduler
+    self.timings = timings
+    self.results = {}
+
+  def Connect(self, mach):
+    """Start a non-blocking connection to a machine.
+
+    Args:
+      mach: A string of the machine name.
+
+    Returns:
+      sock: A socket object, or None when the connection failed outright.
+    """
+    address = ResolveHost(mach, self.port)
+    if address is None:
+      return None
+    family, sockaddr = address
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    err = sock.connect_ex(sockaddr)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      sock.close()
+      return None
+    return sock
+
+  def Classify(self, greeting):
+    """Decide what kind of service answered.
+
+    Args:
+      greeting: A string of the bytes read from the machine.
+
+    Returns:
+      A string of PROBE_SSH or PROBE_NON_SSH.
+    """
+    if greeting.startswith(self.banner):
+      return PROBE_SSH
+    return PROBE_NON_SSH
+
+  def Probe(self, machines):
+    """Probe every machine and sort them by what answered.
+
+    Args:
+      machines: A list of machine names.
+
+    Returns:
+      available: A list of machines answering with an SSH banner.
+      unreachable: A list of machines that could not be connected to.
+      non_ssh: A list of machines answering with something other than SSH.
+    """
+    scheduler = self.scheduler
+    # grouping and connecting would otherwise resolve one machine at a time
+    ResolveHosts(machines, self.timeout)
+    # group -> deque of (ready time, machine, attempt) waiting to be probed
+    pending = collections.OrderedDict()
+    for mach in machines:
+      pending.setdefault(scheduler.GroupKey(mach), collections.deque()).append(
+          (0, mach, 0))
+    # fd -> [socket, machine, deadline, connected, greeting, attempt, start].
+    # every probe shares the timeout so insertion order is deadline order.
+    active = collections.OrderedDict()
+    poller = select.poll()
+
+    def Finish(fd, result, ok=True):
+      sock, mach, _, _, _, _, start = active.pop(fd)
+      poller.unregister(fd)
+      sock.close()
+      end = time.time()
+      scheduler.Release(mach, end - start, ok)
+      self.results[mach] = result
+      if self.timings:
+        self.timings.Span(mach, 'probe', start, end, async_id=mach,
+                          result=result)
+        self.timings.Count(mach, probe=end - start)
+
+    while pending or active:
+      now = time.time()
+      backing_off = False
+      for group in pending.keys():
+        queue = pending[group]
+        while queue and len(active) < self.concurrency:
+          ready_at, mach, attempt = queue[0]
+          if ready_at > now:
+            backing_off = True
+            break
+          if not scheduler.TryAcquire(mach):
+            break
+          queue.popleft()
+          sock = self.Connect(mach)
+          if sock is None:
+            scheduler.Release(mach)
+            self.results[mach] = PROBE_UNREACHABLE
+            continue
+          fd = sock.fileno()
+          active[fd] = [sock, mach, now + self.timeout, False, '', attempt,
+                        now]
+          poller.register(fd, select.POLLOUT)
+        if not queue:
+          del pending[group]
+        if scheduler.Saturated() or len(active) >= self.concurrency:
+          break
+
+      if not active:
+        if pending:
+          time.sleep(0.05)
+        continue
+      first_deadline = active.itervalues().next()[2]
+      wait_ms = max(0, int((first_deadline - time.time()) * 1000))
+      if backing_off:
+        wait_ms = min(wait_ms, 50)
+      for fd, event in poller.poll(wait_ms):
+        if fd not in active:
+          continue
+        sock, mach, _, connected, greeting = active[fd][:5]
+        if not connected:
+          if (event & (select.POLLERR | select.POLLHUP) or
+              sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)):
+            Finish(fd, PROBE_UNREACHABLE)
+          else:
+            active[fd][3] = True
+            poller.modify(fd, select.POLLIN)
+          continue
+        try:
+          chunk = sock.recv(256)
+        except socket.error:
+          chunk = ''
+        greeting += chunk
+        active[fd][4] = greeting
+        if not chunk or '\n' in greeting or len(greeting) >= 255:
+          Finish(fd, self.Classify(greeting))
+
+      now = time.time()
+      while active:
+        fd, probe = active.iteritems().next()
+        if probe[2] > now:
+          break
+        _, mach, _, connected, greeting, attempt, _ = probe
+        if connected:
+          Finish(fd, self.Classify(greeting))
+          continue
+        # a connect that times out may just be a dropped SYN, so retry it
+        Finish(fd, PROBE_UNREACHABLE, ok=False)
+        if attempt < scheduler.retries:
+          pending.setdefault(scheduler.GroupKey(mach),
+                             collections.deque()).append(
+                                 (now + scheduler.Backoff(attempt), mach,
+                                  attempt + 1))
+
+    available = []
+    unreachable = []
+    non_ssh = []
+    for mach in machines:
+      result = self.results[mach]
+      if result == PROBE_SSH:
+        available.append(mach)
+      elif result == PROBE_NON_SSH:
+        non_ssh.append(mach)
+      else:
+        unreachable.append(mach)
+    return available, unreachable, non_ssh
+
+
+class StringTable(object):
+  """Intern strings as small integer IDs.
+
+  One table is shared by every index of a run so each distinct value is held
+  once, however many machines and config files carry it.
+  """
+
+  def __init__(self):
+    """Initializes an empty table."""
+    self.strings = []
+    self.ids = {}
+
+  def Intern(self, string):
+    """Look up the ID of a string, adding it when new.
 
     Args:
-      queue: An int of the size of the threading queue.
-      delimiter: A string of the key/value delimiter.
-      tmp_dir: A string of the temporary directory.
-      conf_instance: A string of the file name and machine name.
+      string: A string to intern.
+
+    Returns:
+      An int of the string ID.
     """
-    threading.Thread.__init__(self)
-    self.delimiter = delimiter
-    self.tmp_dir = tmp_dir
-    self.conf_instance = conf_instance
-    self.file_path = '%s/%s' % (self.tmp_dir, self.conf_instance)
-    self.mach_name = ''
-    self.directives = []
-    self.effective_config = []
-    self.delimiter_error = False
+    string_id = self.ids.get(string)
+    if string_id is None:
+      string_id = self.ids[string] = len(self.strings)
+      self.strings.append(string)
+    return string_id
 
-  def ParseFile(self):
-    """Parse the configuration file."""
-    with open(self.file_path) as file_obj:
-      data = file_obj.readlines()
-      for line in data:
-        self.StoreKeyValue(line)
+  def Lookup(self, string_id):
+    """Look up the string behind an ID.
 
-  def StoreKeyValue(self, line):
-    """Split the wheat from the chaff.
-    
     Args:
-      line: A string of text.
+      string_id: An int of the string ID.
+
+    Returns:
+      The interned string.
     """
-    line = line.strip()
-    line = line.replace('\t', ' ')
-    # eliminate lines that aren't meaningful configuration
-    if re.match(r'[a-zA-Z0-9$]', line):
-      if len(line.split(self.delimiter)) == 0:
-        print 'This is highly irregular' # "Airplane 2"
-      elif len(line.split(self.delimiter)) == 1:
-        # this might happen when a delimiter is not provided
-        self.directive = ''.join(line.split(self.delimiter)[0])
-        self.detail = ''
-        self.delimiter_error = True
-      elif len(line.split(self.delimiter)) == 2:
-        self.directive, self.detail = line.split(self.delimiter)
-      elif len(line.split(self.delimiter)) >= 3:
-        self.directive = ''.join(line.split(self.delimiter)[0])
-        self.detail = self.delimiter.join(line.split(self.delimiter)[1:])
-
-      self.directives.append(self.directive)
-      appended_comments = re.compile(r'(?P<config>[^#;/!]*)[^#;/!]([;]|[#]|[!]'
-                                      '|[/]{2}).*')
-      # strip out where comments append the configuration text
-      if appended_comments.match(self.detail):
-        self.config_dict = appended_comments.match(self.detail).groupdict()
-        line_conf = self.config_dict['config']
-      else:
-        line_conf = self.detail
-      line_conf = line_conf.strip()
-      config_tuple = (self.directive, line_conf)
-      self.effective_config.append(config_tuple)
+    return self.strings[string_id]
 
-  def run(self):
-    """The worker method."""
-    self.mach_name = self.conf_instance.split('_')[-1]
-    self.ParseFile()
 
+class DirectiveColumn(object):
+  """The values every variant holds for one directive, as integer arrays.
 
-class FetchRemoteConfig(threading.Thread):
-  """Gather remote configuration files onto the localhost."""
+  Variants are appended in increasing variant ID order, so the values of a
+  variant are found by bisecting variant_ids and slicing value_ids between
+  its two offsets.
+  """
 
-  def __init__(self, queue, configfile, user, password, tmp_dir, verbose):
-    """Initializes the class with some constants.
+  __slots__ = ('variant_ids', 'offsets', 'value_ids')
+
+  def __init__(self):
+    """Initializes an empty column."""
+    self.variant_ids = array.array('i')
+    self.offsets = array.array('i', [0])
+    self.value_ids = array.array('i')
+
+  def Append(self, variant_id, value_ids):
+    """Add the values of a new variant.
 
     Args:
-      queue: An int of the size of the threading queue.
-      password: A int of the size of the threading queue.
+      variant_id: An int greater than every variant ID already present.
+      value_ids: A list of the string IDs of the values.
     """
-    threading.Thread.__init__(self)
-    self.queue = queue
-    self.configfile = configfile
-    self.user = user
-    self.password = password
-    self.tmp_dir = tmp_dir
-    self.scp_template = ('/usr/bin/scp -q -o ConnectTimeout=3 -p %s@%s:%s '
-                         '%s/%s')
-    self.verbose = verbose
+    self.variant_ids.append(variant_id)
+    self.value_ids.extend(value_ids)
+    self.offsets.append(len(self.value_ids))
 
-  def RetrieveFile(self):
-    """Fetch the remote file over SSH."""
-    if self.password:
-      self.DoManualAuth()
-    else:
-      try:
-        error = subprocess.Popen(self.scp_command, shell=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE).communicate()[1]
-        if error and self.verbose is True:
-          print '%s said: %s' % (self.mach, error.strip())
-      except:
-        print('could not fetch config file from %s' % self.mach)
-
-  def DoManualAuth(self):
-    """Pass an SSH session a user supplied password."""
-    # if scp succeeds with the given password then an exception will be thrown
-    # silently. otherwise if the password is wrong then just warn the user.
-    try:
-      self.ssh_conn = pexpect.spawn(self.scp_command, timeout=3)
-      self.ssh_conn.expect('assword:')
-      self.ssh_conn.sendline(self.password)
-      i = self.ssh_conn.expect(['assword:', 'ermission denied',
-                                'o such file or directory'])
-      if i == 0:
-        print 'your password failed on %s' % self.mach
-        self.ssh_conn.close(force=True)
-      elif i == 1 and self.verbose is True:
-        print 'file inaccessible on %s' % self.mach
-      elif i == 2 and self.verbose is True:
-        print 'file does not exist on %s' % self.mach
-    except Exception, err:
-      if self.ssh_conn:
-        self.ssh_conn.close(force=True)
-    else:
-      if self.ssh_conn:
-        self.ssh_conn.close()
+  def Values(self, variant_id):
+    """Look up the values of a variant.
+
+    Args:
+      variant_id: An int of the variant ID.
+
+    Returns:
+      An array of string IDs, empty when the variant lacks the directive.
+    """
+    position = bisect.bisect_left(self.variant_ids, variant_id)
+    if (position == len(self.variant_ids) or
+        self.variant_ids[position] != variant_id):
+      return self.value_ids[0:0]
+    return self.value_ids[self.offsets[position]:self.offsets[position + 1]]
+
+  def Items(self):
+    """Iterate over the variants holding the directive.
+
+    Yields:
+      (variant ID, array of string IDs) tuples.
+    """
+    for position, variant_id in enumerate(self.variant_ids):
+      yield variant_id, self.value_ids[self.offsets[position]:
+                                       self.offsets[position + 1]]
 
-  def run(self):
-    """The worker method."""
-    while True:
-      self.mach = self.queue.get()
-      self.local_file = '%s_%s' % (self.configfile.replace('/', '_'), self.mach)
-      self.scp_command = self.scp_template % (self.user, self.mach,
-                                              self.configfile, self.tmp_dir,
-                                              self.local_file)
-      self.RetrieveFile()
-      self.queue.task_done()
 
+class ConfigDiffIndex(object):
+  """A directive to variant to values index of parsed configurations.
 
-class ExecuteNetcat(threading.Thread):
-  """The class to run a network connection."""
+  Machines carrying byte-identical copies of a config file share a variant,
+  keyed by the content digest, so each variant is parsed and indexed once no
+  matter how many machines hold it. Machines and variants are numbered, values
+  are interned in a StringTable and each directive keeps a DirectiveColumn,
+  so the index costs a few integers per value instead of Python objects.
+  """
 
-  def __init__(self, queue):
-    """The method to set some constants.
+  def __init__(self, conf_file='', machine_order=(), strings=None):
+    """Initializes an empty index.
 
     Args:
-      queue: An int as the queue size.
+      conf_file: A string of the config file path being compared.
+      machine_order: A list of machine names giving the rendered order.
+      strings: A StringTable to intern the values in, defaults to a new one.
     """
-    threading.Thread.__init__(self)
-    self.queue = queue
-    self.nc_command = '/bin/nc -w 1 %s 22'
-    self.short_banner = 'SSH-2.0-OpenSSH_'
-    self.available_machs = []
-
-  def RunNc(self):
-    """Execute the network connection test."""
-    check_command = self.nc_command % self.mach
-    output = subprocess.Popen(check_command, shell=True,
-                              stdout=subprocess.PIPE).communicate()[0]
-    if output.startswith(self.short_banner):
-      self.available_machs.append(self.mach)
+    self.conf_file = conf_file
+    self.machine_rank = dict((mach, rank)
+                             for rank, mach in enumerate(machine_order))
+    if strings is None:
+      strings = StringTable()
+    self.strings = strings
+    self.machines = []
+    self.machine_ids = {}
+    # machine ID -> variant ID
+    self.machine_variant = array.array('i')
+    # digest -> variant ID and back
+    self.variant_ids = {}
+    self.digests = []
+    # variant ID -> array of the machine IDs holding that variant
+    self.variant_machines = []
+    self.heldback_variants = set()
+    self.visible_directives = set()
+    self.max_mach_len = 0
+    # (section, directive) -> DirectiveColumn
+    self.directives = {}
+    self.heldback = False
 
-  def run(self):
-    """The worker method."""
-    while True:
-      self.mach = self.queue.get()
-      self.RunNc()
-      self.queue.task_done()
+  def AddConfig(self, mach_name, effective_config, delimiter_error=False,
+                digest=None):
+    """Fold a newly parsed variant and its first machine into the index.
+
+    Variants whose parse hit a delimiter error still count towards the
+    missing directive totals but are held back from the rendered output.
+
+    Args:
+      mach_name: A string of the machine name.
+      effective_config: A list of (section, directive, value) tuples.
+      delimiter_error: A boolean of whether the parser hit a bad delimiter.
+      digest: A string of the content digest, defaults to a variant of its
+        own for the machine.
+    """
+    if digest is None:
+      digest = 'machine:%s' % mach_name
+    variant_id = len(self.digests)
+    self.variant_ids[digest] = variant_id
+    self.digests.append(digest)
+    self.variant_machines.append(array.array('i'))
+    if delimiter_error:
+      self.heldback = True
+      self.heldback_variants.add(variant_id)
+    # gather the values of a directive so its column gets one run of them
+    variant_values = {}
+    intern = self.strings.Intern
+    for section, name, detail in effective_config:
+      variant_values.setdefault((section, name), []).append(intern(detail))
+    for directive, value_ids in variant_values.iteritems():
+      column = self.directives.get(directive)
+      if column is None:
+        column = self.directives[directive] = DirectiveColumn()
+      column.Append(variant_id, value_ids)
+      if not delimiter_error:
+        self.visible_directives.add(directive)
+    self.AddMachine(mach_name, digest)
+
+  def AddMachine(self, mach_name, digest):
+    """Fold a machine holding an already indexed variant into the index.
+
+    Args:
+      mach_name: A string of the machine name.
+      digest: A string of the content digest.
+
+    Returns:
+      A boolean of whether the variant was known.
+    """
+    variant_id = self.variant_ids.get(digest)
+    if variant_id is None:
+      return False
+    machine_id = len(self.machines)
+    self.machines.append(mach_name)
+    self.machine_ids[mach_name] = machine_id
+    self.machine_variant.append(variant_id)
+    self.variant_machines[variant_id].append(machine_id)
+    if variant_id not in self.heldback_variants:
+      self.max_mach_len = max(self.max_mach_len, len(mach_name))
+    return True
+
+  def Histogram(self, directive):
+    """Count the machines holding each value of a directive.
+
+    Args:
+      directive: A (section, directive) tuple.
+
+    Returns:
+      histogram: A Counter of value -> number of machines holding it.
+    """
+    value_counts = collections.Counter()
+    for variant_id, value_ids in self.directives[directive].Items():
+      mach_count = len(self.variant_machines[variant_id])
+      for value_id in set(value_ids):
+        value_counts[value_id] += mach_count
+    lookup = self.strings.Lookup
+    return collections.Counter(dict((lookup(value_id), count) for value_id,
+                                    count in value_counts.iteritems()))
+
+  def MissingCount(self, directive):
+    """Count the machines where a directive is absent.
+
+    Args:
+      directive: A (section, directive) tuple.
+
+    Returns:
+      An int of the machines without the directive.
+    """
+    present = sum(len(self.variant_machines[variant_id])
+                  for variant_id in self.directives[directive].variant_ids)
+    return len(self.machines) - present
+
+  def MachineValues(self, directive, mach_name):
+    """Look up the values a machine holds for a directive.
+
+    Args:
+      directive: A (section, directive) tuple.
+      mach_name: A string of the machine name.
+
+    Returns:
+      A list of values, empty when the directive is absent.
+    """
+    variant_id = self.machine_variant[self.machine_ids[mach_name]]
+    return map(self.strings.Lookup,
+               self.directives[directive].Values(variant_id))
+
+  def ValueMachines(self, directive):
+    """Group the rendered machines by the values they hold for a directive.
+
+    Args:
+      directive: A (section, directive) tuple.
+
+    Returns:
+      A dict of value -> list of machine names in the requested order.
+    """
+    value_machines = collections.defaultdict(list)
+    for variant_id, value_ids in self.directives[directive].Items():
+      if variant_id in self.heldback_variants:
+        continue
+      variant_machs = [self.machines[machine_id] for machine_id
+                       in self.variant_machines[variant_id]]
+      for value_id in set(value_ids):
+        value_machines[self.strings.Lookup(value_id)].extend(variant_machs)
+    return dict((value, self.OrderedMachines(value_machs))
+                for value, value_machs in value_machines.iteritems())
+
+  def VariantValues(self, directive, digest):
+    """Look up the values a variant holds for a directive.
+
+    Args:
+      directive: A (section, directive) tuple.
+      digest: A string of the content digest.
+
+    Returns:
+      A list of values, empty when the directive is absent.
+    """
+    return map(self.strings.Lookup,
+               self.directives[directive].Values(self.variant_ids[digest]))
+
+  def VariantMachines(self, digest):
+    """List the machines holding a variant.
+
+    Args:
+      digest: A string of the content digest.
+
+    Returns:
+      A list of machine names.
+    """
+    return [self.machines[machine_id] for machine_id
+            in self.variant_machines[self.variant_ids[digest]]]
+
+  def OrderedMachines(self, machines=None):
+    """List the rendered machines in the requested machine order.
+
+    Args:
+      machines: A list of machine names, defaults to every machine.
+
+    Returns:
+      A list of machine names.
+    """
+    if machines is None:
+      machines = self.machines
+    last_rank = len(self.machine_rank)
+    return sorted((mach for mach in machines
+                   if self.machine_variant[self.machine_ids[mach]]
+                   not in self.heldback_variants),
+                  key=lambda mach: self.machine_rank.get(mach, last_rank))
+
+  def OrderedVariants(self):
+    """List the rendered variants, most widely held first.
+
+    Variants held by as many machines go in the requested machine order, so
+    the labels do not depend on which fetch finished first.
+
+    Returns:
+      A list of digests.
+    """
+    last_rank = len(self.machine_rank)
+
+    def SortKey(variant_id):
+      first_rank = min(self.machine_rank.get(self.machines[machine_id],
+                                             last_rank)
+                       for machine_id in self.variant_machines[variant_id])
+      return -len(self.variant_machines[variant_id]), first_rank
+    return [self.digests[variant_id] for variant_id in sorted(
+        (variant_id for variant_id in range(len(self.digests))
+         if variant_id not in self.heldback_variants), key=SortKey)]
+
+
+def FindOutliers(histogram, mode=OUTLIER_UNIQUE, threshold=10.0):
+  """Pick out the values that stand apart from the rest of the fleet.
+
+  Args:
+    histogram: A Counter of value -> number of machines holding it.
+    mode: A string of the outlier test. OUTLIER_UNIQUE flags values held by a
+      single machine, OUTLIER_MINORITY flags values held by fewer than
+      threshold percent of the machines and OUTLIER_MAJORITY flags every value
+      that differs from the most common one.
+    threshold: A float of the percentage used by OUTLIER_MINORITY.
+
+  Returns:
+    outliers: A set of the outlying values.
+  """
+  if mode == OUTLIER_UNIQUE:
+    return set(value for value, count in histogram.iteritems() if count == 1)
+  elif mode == OUTLIER_MINORITY:
+    total = sum(histogram.itervalues())
+    return set(value for value, count in histogram.iteritems()
+               if count * 100.0 / total < threshold)
+  elif mode == OUTLIER_MAJORITY:
+    if not histogram:
+      return set()
+    top_count = max(histogram.itervalues())
+    return set(value for value, count in histogram.iteritems()
+               if count < top_count)
+  raise ValueError('unknown outlier mode %s' % mode)
 
 
 def CommaSeparateValues(value):
@@ -208,114 +1931,574 @@ def CommaSeparateValues(value):
   return csv_list 
 
 
-def CheckReachAbility(machines):
-  """Establish reachability for each remote machine.
+def DetectFormat(conf_file, content):
+  """Guess the syntax of a config file from its name and content.
+
+  A file is INI when it has [section] lines, or when its name has an INI
+  suffix and most of its lines are key=value. Many .cfg files, such as
+  haproxy.cfg and grub.cfg, are space delimited.
+
+  Args:
+    conf_file: A string of the config file path.
+    content: A string of the config file bytes.
+
+  Returns:
+    A string of FORMAT_KV, FORMAT_INI or FORMAT_SSHD.
+  """
+  base_name = os.path.basename(conf_file)
+  if base_name in SSHD_FILES:
+    return FORMAT_SSHD
+  head = content[:DETECT_BYTES]
+  if INI_SECTION_LINE.search(head):
+    return FORMAT_INI
+  if base_name.endswith(INI_SUFFIXES):
+    lines = [line for line in head.splitlines() if MEANINGFUL_LINE.search(line)
+             and not line.lstrip().startswith(('#', ';'))]
+    if lines and 2 * len(INI_KEY_VALUE_LINE.findall(head)) > len(lines):
+      return FORMAT_INI
+  return FORMAT_KV
+
+
+def FormatDirective(directive):
+  """Render an index key for display.
+
+  Args:
+    directive: A (section, directive) tuple.
+
+  Returns:
+    A string of the directive, prefixed by its section when it has one.
+  """
+  section, name = directive
+  if section:
+    return '[%s] %s' % (section, name)
+  return name
+
+
+def IterLines(content):
+  """Walk the lines of a buffer without splitting it into a list up front.
+
+  Args:
+    content: A string of bytes.
+
+  Yields:
+    Each line of the buffer, line ending included.
+  """
+  start = 0
+  end = len(content)
+  while start < end:
+    newline = content.find('\n', start)
+    if newline == -1:
+      yield content[start:]
+      return
+    yield content[start:newline + 1]
+    start = newline + 1
+
+
+def MaxOpenSockets():
+  """Work out how many sockets can be opened alongside everything else.
+
+  Returns:
+    An int of the sockets available under the open file limit.
+  """
+  soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+  if soft_limit == resource.RLIM_INFINITY:
+    return 65536
+  # leave room for stdio, the ssh pipes and the config files
+  return max(1, soft_limit - 64)
+
+
+def StartFetchers(transport, machines, configfiles, scheduler, cache=None,
+                  known_digests=None, timings=None):
+  """Start the fetch workers and hand them every machine.
+
+  Args:
+    transport: An SshTransport or LocalDirTransport to fetch with.
+    machines: A list of machine names.
+    configfiles: A list of the absolute config file paths.
+    scheduler: A HostScheduler pacing the fetches.
+    cache: A ContentCache to check before fetching, or None.
+    known_digests: A dict of (machine, config file) -> digest of content
+      that need not be fetched again, or None.
+    timings: A Timings to record each fetch in, or None.
+
+  Returns:
+    parse_queue: A bounded Queue.Queue the workers feed, as described by
+      FetchRemoteConfig.
+  """
+  if not scheduler.local and not scheduler.jump_host:
+    # grouping would otherwise resolve one machine at a time, and after
+    # probing every answer is remembered already
+    ResolveHosts(machines)
+  fetch_queue = Queue.Queue()
+  parse_queue = Queue.Queue(maxsize=scheduler.limit * (len(configfiles) + 1))
+  for fetch_conn in range(min(scheduler.limit, len(machines))):
+    fetch_thread = FetchRemoteConfig(fetch_queue, transport, configfiles,
+                                     parse_queue, scheduler, cache,
+                                     known_digests, timings)
+    fetch_thread.setDaemon(True)
+    fetch_thread.start()
+  queued = time.time()
+  for mach in machines:
+    fetch_queue.put((mach, queued))
+  return parse_queue
+
+
+def ParseContent(configfile, mach, content, delimiter, conf_format,
+                 timings=None, formats=None):
+  """Parse one fetched copy of a config file.
+
+  Args:
+    configfile: A string of the config file path.
+    mach: A string of the machine name.
+    content: A string of the config file bytes.
+    delimiter: A string of the key/value delimiter, None for the format's
+      default.
+    conf_format: A string of the config file syntax, FORMAT_AUTO to guess it.
+    timings: A Timings to record the parse in, or None.
+    formats: A dict of config file path -> the syntax guessed from its first
+      copy with content, shared by the copies so every machine is read the
+      same way, or None to guess per copy.
+
+  Returns:
+    A parsed ParseConfigFile.
+  """
+  start = time.time()
+  if conf_format == FORMAT_AUTO:
+    if formats is not None and configfile in formats:
+      conf_format = formats[configfile]
+    else:
+      conf_format = DetectFormat(configfile, content)
+      if formats is not None and content.strip():
+        formats[configfile] = conf_format
+  parser = ParseConfigFile(delimiter, mach, content, conf_format).Parse()
+  if timings:
+    timings.Parse(mach, configfile, start, time.time(), content)
+  return parser
+
+
+def FetchAndIndex(transport, machines, configfiles, delimiter,
+                  fetch_workers=5, cache=None, scheduler=None,
+                  conf_format=FORMAT_AUTO, store=None, timings=None):
+  """Fetch, parse and index the config files as a stream.
+
+  Every file is parsed as soon as it lands and folded straight into the
+  index for its config file, so parsing overlaps with the fetches still in
+  flight. Copies identical to one already indexed skip the parse. File
+  content never touches the disk and is dropped once parsed, and the bounded
+  parse queue stalls the fetches if parsing falls behind.
+
+  Args:
+    transport: An SshTransport or LocalDirTransport to fetch with.
+    machines: A list of machine names.
+    configfiles: A list of the absolute config file paths.
+    delimiter: A string of the key/value delimiter, None for the format's
+      default.
+    fetch_workers: An int of the machines fetched from at once when no
+      scheduler is given.
+    cache: A ContentCache to check before fetching, or None.
+    scheduler: A HostScheduler pacing the fetches, or None.
+    conf_format: A string of the config file syntax, FORMAT_AUTO to guess it
+      per file.
+    store: A SnapshotStore to record every machine's config in, or None.
+    timings: A Timings to record the fetches and parses in, or None.
+
+  Returns:
+    indexes: An OrderedDict of config file path -> ConfigDiffIndex.
+  """
+  strings = StringTable()
+  indexes = collections.OrderedDict(
+      (configfile, ConfigDiffIndex(configfile, machines, strings))
+      for configfile in configfiles)
+  if scheduler is None:
+    scheduler = HostScheduler(fetch_workers, fetch_workers,
+                              min_limit=fetch_workers, retries=0,
+                              local=isinstance(transport, LocalDirTransport))
+  parse_queue = StartFetchers(transport, machines, configfiles, scheduler,
+                              cache, timings=timings)
+  formats = {}
+  if store:
+    previous = dict((configfile, store.Digests(configfile))
+                    for configfile in configfiles)
+
+  machs_left = len(machines)
+  while machs_left:
+    configfile, mach, content = parse_queue.get()
+    if configfile is None:
+      machs_left -= 1
+      continue
+    digest = hashlib.sha256(content).hexdigest()
+    diff_index = indexes[configfile]
+    # identical copies only need to be parsed once
+    if not diff_index.AddMachine(mach, digest):
+      parser = ParseContent(configfile, mach, content, delimiter, conf_format,
+                            timings, formats)
+      diff_index.AddConfig(mach, parser.effective_config,
+                           parser.delimiter_error, digest)
+      if store:
+        store.SaveVariant(digest, parser.effective_config,
+                          parser.delimiter_error)
+    if store:
+      store.Record(mach, configfile, digest,
+                   previous[configfile].get(mach, ''))
+  return indexes
+
+
+def DiffConfigs(old_config, new_config):
+  """Work out what changed between two parses of a config file.
+
+  Args:
+    old_config: A list of (section, directive, value) tuples.
+    new_config: A list of (section, directive, value) tuples.
+
+  Returns:
+    removed: A sorted list of the tuples only in old_config.
+    added: A sorted list of the tuples only in new_config.
+  """
+  old_lines = collections.Counter(old_config)
+  new_lines = collections.Counter(new_config)
+  return (sorted((old_lines - new_lines).elements()),
+          sorted((new_lines - old_lines).elements()))
+
+
+def CheckDrift(transport, machines, configfiles, delimiter, store, color,
+               since=None, cache=None, scheduler=None,
+               conf_format=FORMAT_AUTO, timings=None, stream=None):
+  """Report how each machine's config files changed since a snapshot.
+
+  Every machine is asked for its file digests first and only the files
+  whose digest moved on since the snapshot are fetched and parsed. Each
+  change is printed as soon as it is known and recorded as the new
+  snapshot.
 
   Args:
+    transport: An SshTransport or LocalDirTransport to fetch with.
     machines: A list of machine names.
+    configfiles: A list of the absolute config file paths.
+    delimiter: A string of the key/value delimiter, None for the format's
+      default.
+    store: A SnapshotStore of the earlier runs.
+    color: A boolean of whether to include colored output.
+    since: A float of the epoch time to compare against, None for the latest
+      snapshot.
+    cache: A ContentCache to check before fetching, or None.
+    scheduler: A HostScheduler pacing the fetches, or None.
+    conf_format: A string of the config file syntax, FORMAT_AUTO to guess it
+      per file.
+    timings: A Timings to record the fetches and parses in, or None.
+    stream: A file object to print the changes to, None for stdout.
 
   Returns:
-    results: A dict of ping results.
-    reachable: A list of machines reachable by ICMP.
-    unreachable: A list of machines not reachable by ICMP.
+    drifted: A list of the machines whose config files changed.
   """
-  fping_command = ('/usr/bin/fping -r 1 -t 1000 %s 2> /dev/null' % 
-                   ' '.join(machines))
-  output = subprocess.Popen(fping_command, shell=True,
-                            stdout=subprocess.PIPE).communicate()[0]
-  reachable = []
-  matcher = r'(?P<mach>.*) is alive$'
-  for match in re.finditer(matcher, output, re.MULTILINE):
-    match_dict = match.groupdict()
-    reachable.extend(match_dict.values())
+  stream = stream or sys.stdout
+  known_digests = {}
+  latest_digests = {}
+  for configfile in configfiles:
+    for mach, digest in store.Digests(configfile, since).iteritems():
+      known_digests[(mach, configfile)] = digest
+    for mach, digest in store.Digests(configfile).iteritems():
+      latest_digests[(mach, configfile)] = digest
+  if scheduler is None:
+    scheduler = HostScheduler(5, 5, min_limit=5, retries=0,
+                              local=isinstance(transport, LocalDirTransport))
+  parse_queue = StartFetchers(transport, machines, configfiles, scheduler,
+                              cache, known_digests, timings)
 
-  unreachable = [down for down in machines if down not in reachable]
-  return reachable, unreachable
+  formats = {}
+  drifted = set()
+  seen = collections.defaultdict(set)
+  machs_left = len(machines)
+  while machs_left:
+    configfile, mach, content = parse_queue.get()
+    if configfile is None:
+      machs_left -= 1
+      # content holds the error of a failed fetch
+      if content is None:
+        for path in configfiles:
+          previous = known_digests.get((mach, path), '')
+          if path not in seen[mach] and previous:
+            PrintDrift(mach, path, 'removed', store.LoadVariant(previous), [],
+                       color, stream)
+            store.Record(mach, path, '',
+                         latest_digests.get((mach, path), ''))
+            drifted.add(mach)
+      seen.pop(mach, None)
+      continue
+    seen[mach].add(configfile)
+    previous = known_digests.get((mach, configfile), '')
+    latest = latest_digests.get((mach, configfile), '')
+    if content is None:
+      store.Record(mach, configfile, previous, latest)
+      continue
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == previous:
+      # fetched without a remote digest to compare, but unchanged
+      store.Record(mach, configfile, previous, latest)
+      continue
+    if not store.HasVariant(digest):
+      parser = ParseContent(configfile, mach, content, delimiter, conf_format,
+                            timings, formats)
+      store.SaveVariant(digest, parser.effective_config,
+                        parser.delimiter_error)
+    if previous:
+      removed, added = DiffConfigs(store.LoadVariant(previous),
+                                   store.LoadVariant(digest))
+      PrintDrift(mach, configfile, 'changed', removed, added, color, stream)
+      drifted.add(mach)
+    elif (mach, configfile) in known_digests:
+      PrintDrift(mach, configfile, 'added', [], store.LoadVariant(digest),
+                 color, stream)
+      drifted.add(mach)
+    else:
+      print >> stream, '%s %s no earlier snapshot, recorded' % (mach,
+                                                                configfile)
+    store.Record(mach, configfile, digest, latest)
+  return [mach for mach in machines if mach in drifted]
 
 
-def PrintPretty(threadlist, color, machines):
+def PrintPretty(diff_index, color, machines, outlier_mode=OUTLIER_UNIQUE,
+                threshold=10.0):
   """Print the output in pure style.
 
   Args:
-    threadlist: A list of thread objects.
+    diff_index: A ConfigDiffIndex of the parsed configurations.
     color: A boolean of whether to include colored output.
     machines: A list of machines.
+    outlier_mode: A string of the FindOutliers test for colored values.
+    threshold: A float of the FindOutliers percentage threshold.
   """
-  heldback_output = False
-  for thread in threadlist:
-    file_name = os.path.basename(thread.file_path)
-    conf_file = '/'.join(file_name.split('_')[:-1])
-    bold_header = '=== ' + '\033[1m' + conf_file + '\033[0m'
+  bold_header = '=== ' + '\033[1m' + diff_index.conf_file + '\033[0m'
   print '\n', bold_header, '\n'
 
-  all_directives = []
-  max_mach_len = 0
-  for thread in threadlist:
-    if thread.delimiter_error:
-      heldback_output = True
-      break
-    for directive in thread.directives:
-      if directive not in all_directives:
-        all_directives.append(directive)
-    if len(thread.mach_name) > max_mach_len:
-      max_mach_len = len(thread.mach_name)
-  max_mach_len += 2
-  all_directives.sort()
-
-  tag_for_color = []
-  directive_counter_dict = {}
-  for sorted_directive in all_directives:
-    directive_counter_dict[sorted_directive] = 0
-    details = []
-    for thread in threadlist:
-      thread_directives = []
-      for config_item in thread.effective_config:
-        a_directive, detail = config_item
-        details.append(detail)
-        thread_directives.append(a_directive)
-      # add a warning counter for the directive when its absent on this machine
-      if sorted_directive not in thread_directives:
-        directive_counter_dict[sorted_directive] += 1
-
-    for item in details:
-      if (details.count(item) == 1 and item not in tag_for_color):
-        if len(machines) > 1:
-          tag_for_color.append(item)
-
-  for sorted_directive in all_directives:
-    if directive_counter_dict[sorted_directive] > 0:
-      if color is False:
-        print (sorted_directive + ' (' +
-               str(directive_counter_dict[sorted_directive]) + ')')
-      else:
-        print (sorted_directive + ' (' + '\033[93m' + 
-               str(directive_counter_dict[sorted_directive]) +
-               '\033[0m') + ' missing: )'
+  spacer = '%' + str(diff_index.max_mach_len + 2) + 's'
+  ordered_machines = diff_index.OrderedMachines()
+  for sorted_directive in sorted(diff_index.visible_directives):
+    if color is not False and len(machines) > 1:
+      outliers = FindOutliers(diff_index.Histogram(sorted_directive),
+                              outlier_mode, threshold)
     else:
-      print sorted_directive
+      outliers = ()
+    PrintDirectiveHeader(FormatDirective(sorted_directive),
+                         diff_index.MissingCount(sorted_directive), color)
 
-    for thread in threadlist:
-      if thread.delimiter_error:
-        heldback_output = True
-        break
-      for config_item in thread.effective_config:
-        a_directive, detail = config_item
-        if a_directive == sorted_directive:
-          spacer = '%' + str(max_mach_len) + 's'
-          mach_output = spacer % thread.mach_name
-          output = '%s  %s' % (mach_output, detail)
-          if detail in tag_for_color:
-            if color is False:
-              print output
-            else:
-              print '\033[91m' + output + '\033[0m'
-          else:
-            print output
-  if heldback_output:
+    for mach_name in ordered_machines:
+      for detail in diff_index.MachineValues(sorted_directive, mach_name):
+        output = '%s  %s' % (spacer % mach_name, detail)
+        if detail in outliers:
+          print '\033[91m' + output + '\033[0m'
+        else:
+          print output
+  if diff_index.heldback:
+    print 'Output was held back. Try using or removing the delimiter flag.'
+  print ''
+
+
+def PrintVariants(diff_index, color, machines, outlier_mode=OUTLIER_UNIQUE,
+                  threshold=10.0, max_listed=10):
+  """Print the output grouped by config file variant.
+
+  Each directive shows every distinct set of values once along with the
+  variants holding it, followed by a legend of the machines per variant.
+
+  Args:
+    diff_index: A ConfigDiffIndex of the parsed configurations.
+    color: A boolean of whether to include colored output.
+    machines: A list of machines.
+    outlier_mode: A string of the FindOutliers test for colored values.
+    threshold: A float of the FindOutliers percentage threshold.
+    max_listed: An int of the most machine names listed per variant.
+  """
+  bold_header = '=== ' + '\033[1m' + diff_index.conf_file + '\033[0m'
+  print '\n', bold_header, '\n'
+
+  ordered_variants = diff_index.OrderedVariants()
+  labels = dict((digest, 'v%d' % number)
+                for number, digest in enumerate(ordered_variants, 1))
+  if ordered_variants:
+    print '%d machines, %d identical, %d variants\n' % (
+        len(diff_index.machines),
+        len(diff_index.VariantMachines(ordered_variants[0])),
+        len(ordered_variants))
+
+  for sorted_directive in sorted(diff_index.visible_directives):
+    if color is not False and len(machines) > 1:
+      outliers = FindOutliers(diff_index.Histogram(sorted_directive),
+                              outlier_mode, threshold)
+    else:
+      outliers = ()
+    PrintDirectiveHeader(FormatDirective(sorted_directive),
+                         diff_index.MissingCount(sorted_directive), color)
+
+    # group the variants agreeing on this directive
+    groups = collections.OrderedDict()
+    for digest in ordered_variants:
+      details = diff_index.VariantValues(sorted_directive, digest)
+      if details:
+        groups.setdefault(tuple(details), []).append(digest)
+    group_labels = []
+    for details, digests in groups.iteritems():
+      mach_count = sum(len(diff_index.VariantMachines(digest))
+                       for digest in digests)
+      group_labels.append('%s (%d)' % (','.join(labels[digest]
+                                                for digest in digests),
+                                       mach_count))
+    spacer = '%' + str(max(len(label) for label in group_labels) + 2) + 's'
+    for group_label, details in zip(group_labels, groups):
+      for detail in details:
+        output = '%s  %s' % (spacer % group_label, detail)
+        if detail in outliers:
+          print '\033[91m' + output + '\033[0m'
+        else:
+          print output
+        group_label = ''
+
+  print ''
+  for digest in ordered_variants:
+    variant_machs = diff_index.OrderedMachines(
+        diff_index.VariantMachines(digest))
+    listed = ', '.join(variant_machs[:max_listed])
+    if len(variant_machs) > max_listed:
+      listed += ' and %d more' % (len(variant_machs) - max_listed)
+    print '%s %s (%d machines): %s' % (labels[digest], digest[:12],
+                                       len(variant_machs), listed)
+  if diff_index.heldback:
     print 'Output was held back. Try using or removing the delimiter flag.'
   print ''
 
 
+def DirectiveRecords(diff_index, machines, outlier_mode=OUTLIER_UNIQUE,
+                     threshold=10.0):
+  """Describe every rendered directive as a plain dict, one at a time.
+
+  Args:
+    diff_index: A ConfigDiffIndex of the parsed configurations.
+    machines: A list of machines.
+    outlier_mode: A string of the FindOutliers test for flagged values.
+    threshold: A float of the FindOutliers percentage threshold.
+
+  Yields:
+    A dict of the config file, section, directive, missing count and a list
+    of values, each with its machines and outlier flag, most held first.
+  """
+  for sorted_directive in sorted(diff_index.visible_directives):
+    if len(machines) > 1:
+      outliers = FindOutliers(diff_index.Histogram(sorted_directive),
+                              outlier_mode, threshold)
+    else:
+      outliers = ()
+    value_machines = diff_index.ValueMachines(sorted_directive)
+    values = []
+    for detail in sorted(value_machines,
+                         key=lambda detail: (-len(value_machines[detail]),
+                                             detail)):
+      values.append({'value': detail, 'machines': value_machines[detail],
+                     'outlier': detail in outliers})
+    section, name = sorted_directive
+    yield {'file': diff_index.conf_file, 'section': section,
+           'directive': name, 'values': values,
+           'missing': diff_index.MissingCount(sorted_directive)}
+
+
+def PrintRecords(indexes, machines, outlier_mode=OUTLIER_UNIQUE,
+                 threshold=10.0, json_array=False):
+  """Stream the directive records as NDJSON or as a JSON array.
+
+  Each record is written and flushed as soon as it is built, so a reader can
+  consume the report while the rest is still being worked out.
+
+  Args:
+    indexes: An iterable of ConfigDiffIndex.
+    machines: A list of machines.
+    outlier_mode: A string of the FindOutliers test for flagged values.
+    threshold: A float of the FindOutliers percentage threshold.
+    json_array: A boolean of whether to wrap the records in a JSON array
+      instead of writing one per line.
+  """
+  if json_array:
+    sys.stdout.write('[')
+  separator = ''
+  for diff_index in indexes:
+    if not diff_index.machines:
+      continue
+    for record in DirectiveRecords(diff_index, machines, outlier_mode,
+                                   threshold):
+      if json_array:
+        sys.stdout.write(separator + json.dumps(record, sort_keys=True))
+        separator = ',\n'
+      else:
+        sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+      sys.stdout.flush()
+  if json_array:
+    sys.stdout.write(']\n')
+
+
+def PrintDirectiveHeader(directive, missing, color):
+  """Print a directive along with how many machines lack it.
+
+  Args:
+    directive: A string of the directive.
+    missing: An int of the machines without the directive.
+    color: A boolean of whether to include colored output.
+  """
+  if missing > 0:
+    if color is False:
+      print directive + ' (' + str(missing) + ')'
+    else:
+      print (directive + ' (' + '\033[93m' + str(missing) +
+             '\033[0m') + ' missing: )'
+  else:
+    print directive
+
+
+def PrintDrift(mach, configfile, status, removed, added, color,
+               stream=None):
+  """Print what changed in one machine's config file.
+
+  Args:
+    mach: A string of the machine name.
+    configfile: A string of the config file path.
+    status: A string of added, changed or removed.
+    removed: A list of the (section, directive, value) tuples taken out.
+    added: A list of the (section, directive, value) tuples put in.
+    color: A boolean of whether to include colored output.
+    stream: A file object to print to, None for stdout.
+  """
+  stream = stream or sys.stdout
+  print >> stream, '%s %s %s' % (mach, configfile, status)
+  for sign, lines, color_code in (('-', removed, '\033[91m'),
+                                  ('+', added, '\033[92m')):
+    for section, directive, detail in lines:
+      output = '  %s %s  %s' % (sign, FormatDirective((section, directive)),
+                                detail)
+      if color is False:
+        print >> stream, output
+      else:
+        print >> stream, color_code + output + '\033[0m'
+
+
+def ParseSince(value):
+  """Turn a --since argument into an epoch time.
+
+  Args:
+    value: A string of 'last' or a YYYY-MM-DD[THH:MM] local time.
+
+  Returns:
+    A float of the epoch time, or None for the latest snapshot.
+
+  Raises:
+    argparse.ArgumentTypeError: The time could not be read.
+  """
+  if value == 'last':
+    return None
+  for time_format in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+    try:
+      return time.mktime(time.strptime(value, time_format))
+    except ValueError:
+      continue
+  raise argparse.ArgumentTypeError('expected last, YYYY-MM-DD or '
+                                   'YYYY-MM-DDTHH:MM')
+
+
 def main():
   parser = argparse.ArgumentParser(description='Compare Unix config files.')
   parser.add_argument('configfiles', metavar='FILE', nargs='*',
@@ -326,7 +2509,11 @@ def main():
                       'configuration file from')
   parser.add_argument('-d', '--delimiter', help='Force a delimiter to separate '
                       'the key/value pair in the config file. Defaults to a '
-                      'space.')
+                      'space, or = for ini files.')
+  parser.add_argument('-f', '--format', choices=FORMATS, default=FORMAT_AUTO,
+                      help='The config file syntax: plain key/value, ini '
+                      'sections or sshd style Match blocks. Defaults to '
+                      'guessing from the file name and content.')
   parser.add_argument('-u', '--user', help='A user to authenticate against '
                       'remote machines')
   parser.add_argument('-p', '--password', action='store_true', help='Use '
@@ -335,6 +2522,75 @@ def main():
                       help='Disable colored output')
   parser.add_argument('-v', '--verbose', action='store_true',
                       help='Include error messages with the output')
+  parser.add_argument('-l', '--local-dir', help='Read the config files from '
+                      'a local directory holding one sub directory per '
+                      'machine instead of over SSH. Without --machines every '
+                      'sub directory is compared.')
+  parser.add_argument('-o', '--outliers', choices=OUTLIER_MODES,
+                      default=OUTLIER_UNIQUE, help='How to pick the values '
+                      'colored as outliers: unique to one machine, held by a '
+                      'minority under the threshold or differing from the '
+                      'majority. Defaults to unique.')
+  parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                      help='The percentage of machines under which a value is '
+                      'a minority outlier. Defaults to 10.')
+  parser.add_argument('-c', '--compact', action='store_true',
+                      help='Group machines holding identical copies of a '
+                      'config file and print each variant once')
+  parser.add_argument('--output', choices=OUTPUTS, default=OUTPUT_TEXT,
+                      help='Print the report as text, or stream one JSON '
+                      'record per directive as NDJSON lines or a JSON '
+                      'array. Defaults to text.')
+  parser.add_argument('-C', '--cache', action='store_true',
+                      help='Ask each machine for the digest of the config '
+                      'files first and only fetch the ones missing from the '
+                      'local cache')
+  parser.add_argument('--cache-dir', default=CACHE_DIR,
+                      help='Where cached config files are kept. Defaults to '
+                      '%(default)s.')
+  parser.add_argument('--cache-size', type=int, default=256,
+                      help='The most megabytes the cache keeps. Defaults to '
+                      '%(default)s.')
+  parser.add_argument('--cache-age', type=int, default=30,
+                      help='The days an unused cache entry is kept. Defaults '
+                      'to %(default)s.')
+  parser.add_argument('-j', '--jobs', type=int, default=32,
+                      help='The most machines fetched from at once. Defaults '
+                      'to %(default)s.')
+  parser.add_argument('--group-jobs', type=int, default=8,
+                      help='The most machines fetched from at once per subnet '
+                      'or jump host. Defaults to %(default)s.')
+  parser.add_argument('--probe-jobs', type=int, default=512,
+                      help='The most machines probed at once. Defaults to '
+                      '%(default)s.')
+  parser.add_argument('--probe-group-jobs', type=int, default=128,
+                      help='The most machines probed at once per subnet. '
+                      'Defaults to %(default)s.')
+  parser.add_argument('--retries', type=int, default=2,
+                      help='How often a failed probe or fetch is retried. '
+                      'Defaults to %(default)s.')
+  parser.add_argument('--timeout', type=int, default=30,
+                      help='The seconds allowed per remote command. Defaults '
+                      'to %(default)s.')
+  parser.add_argument('-S', '--snapshot', action='store_true',
+                      help='Record every machine\'s parsed config in the '
+                      'snapshot database')
+  parser.add_argument('--since', nargs='?', const='last', type=ParseSince,
+                      default=False, help='Only fetch the config files whose '
+                      'digest changed since the last snapshot, or the one '
+                      'in place at YYYY-MM-DD[THH:MM], print the changes and '
+                      'record the new snapshot')
+  parser.add_argument('--snapshot-db', default=SNAPSHOT_DB,
+                      help='The snapshot database. Defaults to %(default)s.')
+  parser.add_argument('--timing', action='store_true',
+                      help='Print how long each phase and the slowest '
+                      'machines took')
+  parser.add_argument('--trace', metavar='FILE', help='Write the phase, '
+                      'probe, fetch and parse timings to FILE in the Chrome '
+                      'trace format')
+  parser.add_argument('-J', '--jump-host', default='',
+                      help='Reach the machines through this SSH jump host. '
+                      'The reachability probe is skipped.')
   args = parser.parse_args()
 
   if args.configfiles:
@@ -343,6 +2599,8 @@ def main():
     parser.error('An argument is required')
 
   machines = args.machines
+  if args.local_dir and not machines:
+    machines = LocalDirTransport(args.local_dir).Machines()
   if machines:
     for mach in machines:
       if '_' in mach:
@@ -360,64 +2618,106 @@ def main():
   if args.delimiter:
     delimiter = args.delimiter
   else:
-    delimiter = ' '
+    delimiter = None
 
-  threadlist = []
-  if machines:
-    reachable, unreachable = CheckReachAbility(machines)
-    nc_queue = Queue.Queue()
-    if len(reachable) <= 10:
-      nc_queue_len = len(reachable)
-    else:
-      nc_queue_len = 10
-    for nc_conn in range(nc_queue_len):
-      nc_thread = ExecuteNetcat(nc_queue)
-      nc_thread.setDaemon(True)
-      threadlist.append(nc_thread)
-      nc_thread.start()
-    for mach in reachable:
-      nc_queue.put(mach)
-    nc_queue.join()
+  # keep stdout parseable when it carries JSON
+  if args.output == OUTPUT_TEXT:
+    status = sys.stdout
+  else:
+    status = sys.stderr
+  timings = None
+  if args.timing or args.trace:
+    timings = Timings()
 
   available_machs = []
-  for thread in threadlist:
-    available_machs.extend(thread.available_machs)
-  print('Proceeding on %d machines: %s' % (len(available_machs),
-                                           ', '.join(available_machs)))
+  transport = None
+  if machines and args.local_dir:
+    transport = LocalDirTransport(args.local_dir)
+    available_machs = machines
+  elif machines and args.jump_host:
+    transport = SshTransport(user, password, args.verbose,
+                             timeout=args.timeout, jump_host=args.jump_host)
+    available_machs = machines
+  elif machines:
+    transport = SshTransport(user, password, args.verbose,
+                             timeout=args.timeout)
+    probe_scheduler = HostScheduler(args.probe_jobs, args.probe_group_jobs,
+                                    min_limit=args.probe_jobs // 8,
+                                    target_latency=1.0, retries=args.retries)
+    prober = HostProber(concurrency=args.probe_jobs,
+                        scheduler=probe_scheduler, timings=timings)
+    start = time.time()
+    available_machs, unreachable, non_ssh = prober.Probe(machines)
+    if timings:
+      timings.Phase('probe', start, time.time())
+    if args.verbose is True:
+      for mach in unreachable:
+        print >> status, '%s is unreachable' % mach
+      for mach in non_ssh:
+        print >> status, '%s did not answer with an SSH banner' % mach
+  try:
+    print >> status, 'Proceeding on %d machines: %s' % (
+        len(available_machs), ', '.join(available_machs))
 
-  tmp_paths = []
-  for configfile in configfiles:
     if available_machs:
-      tmp_dir = tempfile.mkdtemp()
-      tmp_paths.append(tmp_dir)
-      scp_queue = Queue.Queue()
-      # please enjoy ssh connections responsibly
-      scp_queue_len = 5
-      threadlist = []
-      for scp_conn in range(scp_queue_len):
-        scp_thread = FetchRemoteConfig(scp_queue, configfile, user, password,
-                                       tmp_dir, args.verbose)
-        scp_thread.setDaemon(True)
-        threadlist.append(scp_thread)
-        scp_thread.start()
-      for mach in available_machs:
-        scp_queue.put(mach)
-      scp_queue.join()
-
-  for tmp_dir in tmp_paths:
-    threadlist = []
-    for conf_instance in os.listdir(tmp_dir):
-      current_thread = ParseConfigFile(delimiter, tmp_dir, conf_instance)
-                                       
-      current_thread.start()
-      current_thread.join()
-      threadlist.append(current_thread)
-    if threadlist:
-      PrintPretty(threadlist, args.nocolor, machines)
-  try:
-    [shutil.rmtree(path) for path in tmp_paths]
-  except:
-    print 'cleanup failed'
+      cache = None
+      if args.cache:
+        cache = ContentCache(args.cache_dir, args.cache_size * 1024 * 1024,
+                             args.cache_age * 86400)
+      fetch_scheduler = HostScheduler(args.jobs, args.group_jobs,
+                                      retries=args.retries,
+                                      jump_host=args.jump_host,
+                                      local=bool(args.local_dir))
+      store = None
+      if args.snapshot or args.since is not False:
+        store = SnapshotStore(args.snapshot_db)
+      start = time.time()
+      if args.since is not False:
+        drifted = CheckDrift(transport, available_machs, configfiles, delimiter,
+                             store, args.nocolor, args.since, cache,
+                             fetch_scheduler, args.format, timings, status)
+        print >> status, '\n%d of %d machines drifted' % (
+            len(drifted), len(available_machs))
+        indexes = {}
+      else:
+        indexes = FetchAndIndex(transport, available_machs, configfiles,
+                                delimiter, cache=cache,
+                                scheduler=fetch_scheduler,
+                                conf_format=args.format, store=store,
+                                timings=timings)
+      if store:
+        store.Close()
+      if cache:
+        cache.Evict()
+      if timings:
+        timings.Phase('fetch and parse', start, time.time())
+
+      start = time.time()
+      if args.output != OUTPUT_TEXT:
+        PrintRecords(indexes.itervalues(), machines, args.outliers,
+                     args.threshold, args.output == OUTPUT_JSON)
+      else:
+        if args.compact:
+          printer = PrintVariants
+        else:
+          printer = PrintPretty
+        for diff_index in indexes.itervalues():
+          if diff_index.machines:
+            printer(diff_index, args.nocolor, machines, args.outliers,
+                    args.threshold)
+      if timings:
+        timings.Phase('render', start, time.time())
+    elif args.output != OUTPUT_TEXT:
+      # an empty report is still a valid document
+      PrintRecords([], machines, json_array=args.output == OUTPUT_JSON)
+  finally:
+    if transport:
+      transport.Close()
+
+  if args.timing:
+    timings.PrintSummary(status)
+  if args.trace:
+    timings.WriteTrace(args.trace)
 
 
 if __name__ == '__main__':